@@ -5,12 +5,12 @@ __version__=(0,10,0)
 __author__='Alex Miłowski'
 __author_email__='alex@milowski.com'
 
-from .context import RedisOutputCache, MetadataService
-from .remote import RemoteTaskContext, RedisContext, TaskEndListener, TaskStartListener, LifecycleListener, run_workflow, compute_vector, trace_vector, \
-                    workflow_archive, restore_workflow, save_workflow, load_workflow, load_workflow_state, workflow_state, is_running, delete_workflow, \
+from .context import RedisOutputCache, MetadataService, RedisFlowStore
+from .remote import RemoteTaskContext, RedisContext, TaskEndListener, TaskStartListener, LifecycleListener, run_workflow, compute_vector, trace_vector, read_trace, current_vector, append_vector, \
+                    workflow_archive, restore_workflow, save_workflow, load_workflow, load_workflow_state, workflow_state, workflow_states, is_running, delete_workflow, \
                     terminate_workflow, restart_workflow, get_failures, set_failures
 from .wait import WaitTaskListener
-from .request import RequestTaskListener
+from .request import RequestTaskListener, AsyncRequestTaskListener, RequestSessions
 from .redis import RedisTaskListener
-from .auth import create_jwt_credential_actor
+from .auth import create_jwt_credential_actor, JWTCredentialActor
 from .cli import cli as main
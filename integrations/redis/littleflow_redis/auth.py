@@ -1,23 +1,144 @@
+import os
+import json
+import logging
+import threading
 from datetime import datetime
 from calendar import timegm
 
 import jwt
 
-def create_jwt_credential_actor(claims,private_key,kid=None,expiry=3600,issuer=None):
-   def actor(input,parameters):
-      headers = {'kid':kid} if kid is not None else {}
+def current_time():
+   return timegm(datetime.utcnow().utctimetuple())
+
+class JWTCredentialActor:
+   """
+   A credential actor that signs JWTs for requests. Signed tokens are cached
+   by claims, kid, and issuer and reused until the refresh margin before
+   they expire. The default margin is taken from the
+   LITTLEFLOW_JWT_REFRESH_MARGIN environment variable (in seconds).
+   """
+
+   def __init__(self,claims,private_key,kid=None,expiry=3600,issuer=None,refresh_margin=None):
+      self._claims = claims
+      self._private_key = private_key
+      self._kid = kid
+      self._expiry = expiry
+      self._issuer = issuer
+      refresh_margin = refresh_margin if refresh_margin is not None else int(os.environ.get('LITTLEFLOW_JWT_REFRESH_MARGIN',300))
+      self._refresh_margin = min(refresh_margin,expiry//2)
+      self._tokens = {}
+      self._lock = threading.Lock()
+      self._signing_count = 0
+      self._refresher = None
+      self._stopping = threading.Event()
+
+   @property
+   def signing_count(self):
+      """
+      The number of tokens that have been signed
+      """
+      return self._signing_count
+
+   @property
+   def refresh_margin(self):
+      return self._refresh_margin
+
+   def key_for(self,claims):
+      return (json.dumps(claims,sort_keys=True,default=str),self._kid,self._issuer)
+
+   def sign(self,claims):
+      headers = {'kid':self._kid} if self._kid is not None else {}
       payload = claims.copy()
-      now = timegm(datetime.utcnow().utctimetuple())
+      now = current_time()
 
       payload['iat'] = now
-      payload['exp'] = now + expiry
-      if issuer!=None:
-         payload['iss'] = issuer
+      payload['exp'] = now + self._expiry
+      if self._issuer!=None:
+         payload['iss'] = self._issuer
       if 'email' not in claims:
-         payload['email'] = issuer
+         payload['email'] = self._issuer
       if 'sub' not in claims:
-         payload['sub'] = issuer
+         payload['sub'] = self._issuer
+
+      token = jwt.encode(payload, self._private_key, algorithm='RS256',headers=headers)
+      with self._lock:
+         self._signing_count += 1
+      return token, payload['exp']
 
-      token = jwt.encode(payload, private_key, algorithm='RS256',headers=headers)
+   def token_for(self,claims):
+      """
+      Returns a cached token for the claims, signing a new one if there is
+      none or it is within the refresh margin of expiring.
+      """
+      key = self.key_for(claims)
+      cached = self._tokens.get(key)
+      if cached is not None and current_time() < cached[1] - self._refresh_margin:
+         return cached[0]
+      with self._lock:
+         cached = self._tokens.get(key)
+         if cached is not None and current_time() < cached[1] - self._refresh_margin:
+            return cached[0]
+      token, expires = self.sign(claims)
+      with self._lock:
+         self._tokens[key] = (token,expires)
       return token
-   return actor
\ No newline at end of file
+
+   def __call__(self,input,parameters):
+      return self.token_for(self._claims)
+
+   def refresh(self):
+      """
+      Re-signs any cached tokens that are close to the refresh margin so they
+      are replaced before a request finds them stale. Returns the number of
+      seconds until the next token needs refreshing.
+      """
+      now = current_time()
+      margin = self._refresh_margin + self._refresh_margin//2
+      with self._lock:
+         tokens = list(self._tokens.items())
+      next_refresh = self._expiry - margin
+      for key, (token, expires) in tokens:
+         if now >= expires - margin:
+            claims = json.loads(key[0])
+            token, expires = self.sign(claims)
+            with self._lock:
+               self._tokens[key] = (token,expires)
+         next_refresh = min(next_refresh,expires - margin - now)
+      return max(next_refresh,1)
+
+   def start_refresher(self):
+      """
+      Starts a background thread that refreshes tokens before they reach the
+      refresh margin so requests never wait on signing.
+      """
+      if self._refresher is not None:
+         return
+      self.token_for(self._claims)
+      self._stopping.clear()
+      def run():
+         delay = 0
+         while not self._stopping.wait(delay):
+            try:
+               delay = self.refresh()
+            except Exception as ex:
+               logging.error(f'Unable to refresh JWT: {ex}')
+               delay = 1
+      self._refresher = threading.Thread(target=run,daemon=True)
+      self._refresher.start()
+
+   def stop_refresher(self):
+      if self._refresher is None:
+         return
+      self._stopping.set()
+      self._refresher.join()
+      self._refresher = None
+
+   def clear(self):
+      with self._lock:
+         self._tokens.clear()
+
+def create_jwt_credential_actor(claims,private_key,kid=None,expiry=3600,issuer=None,refresh_margin=None,background_refresh=False):
+   actor = JWTCredentialActor(claims,private_key,kid=kid,expiry=expiry,issuer=issuer,refresh_margin=refresh_margin)
+   if background_refresh:
+      actor.start_refresher()
+   return actor
@@ -11,9 +11,10 @@ import click
 from rqse import EventClient, receipt_for, message, ReceiptListener
 import redis
 
-from littleflow_redis import run_workflow, TaskEndListener, TaskStartListener, LifecycleListener, WaitTaskListener, RequestTaskListener, RedisTaskListener
-from littleflow_redis import compute_vector, trace_vector
+from littleflow_redis import run_workflow, TaskEndListener, TaskStartListener, LifecycleListener, WaitTaskListener, RequestTaskListener, AsyncRequestTaskListener, RedisTaskListener
+from littleflow_redis import current_vector, trace_vector
 from littleflow_redis import create_jwt_credential_actor
+from littleflow_redis.context import metadata_watch
 
 default_stream_key = 'workflows:run'
 default_workflows_key = 'workflows:all'
@@ -98,8 +99,10 @@ def run(stream,workflow_id,wait,host,port,username,password,workflow,input):
 @click.option('--username',help='The Redis username',default=os.environ.get('REDIS_USERNAME'))
 @click.option('--password',help='The Redis authentication',default=os.environ.get('REDIS_PASSWORD'))
 @click.option('--issuer',help='The key configuration for JWT authentication',default=os.environ.get('ISSUER'))
+@click.option('--request-concurrency',help='The maximum number of requests in flight',type=int,default=int(os.environ.get('LITTLEFLOW_REQUEST_CONCURRENCY',1)))
+@click.option('--watch-metadata',is_flag=True,help='Invalidate cached metadata with keyspace notifications',default=metadata_watch())
 @click.option('--log-level',help='Sets the log level',type=click.Choice(['debug','info','warning','error','critical']),default=os.environ.get('LOG_LEVEL'))
-def worker(stream,group,lifecycle_group,workflows,inprogress,host,port,username,password,issuer,log_level):
+def worker(stream,group,lifecycle_group,workflows,inprogress,host,port,username,password,issuer,request_concurrency,watch_metadata,log_level):
 
    set_log_level(log_level)
 
@@ -128,7 +131,10 @@ def worker(stream,group,lifecycle_group,workflows,inprogress,host,port,username,
    wait.start()
 
    # This processes the request steps
-   request_listener = RequestTaskListener(stream,credential_actor=auth_actor,host=host,port=port,username=username,password=password)
+   if request_concurrency>1:
+      request_listener = AsyncRequestTaskListener(stream,credential_actor=auth_actor,host=host,port=port,username=username,password=password,max_in_flight=request_concurrency,watch_metadata=watch_metadata)
+   else:
+      request_listener = RequestTaskListener(stream,credential_actor=auth_actor,host=host,port=port,username=username,password=password,watch_metadata=watch_metadata)
 
    request = threading.Thread(target=lambda : request_listener.listen())
    request.start()
@@ -298,7 +304,7 @@ def adjust(all,host,port,username,password,workflow_id):
          for tstamp in sorted(vectors.keys()):
             value = vectors[tstamp]
             print(name,format_vector(value.flatten()),tstamp.isoformat())
-      V = compute_vector(client,key+':'+name)
+      V = current_vector(client,key+':'+name)
       if V is not None:
          print(name,format_vector(V.flatten()))
 
@@ -651,10 +651,15 @@ class App {
        })
    }
    fetchWorkflowTrace(workflow,callback) {
-      fetch(`service/workflows/${workflow.id}/trace/S`)
+      // only the entries since the last fetch are requested
+      let incremental = workflow.S != null && workflow.traceCursor != null
+      let cursor = incremental ? workflow.traceCursor : 0
+      fetch(`service/workflows/${workflow.id}/trace/S?cursor=${cursor}&format=columns`)
        .then(response => this.responseFilter(response))
        .then(data => {
-          workflow.S = data
+          let entries = data.timestamps.map((tstamp,index) => [tstamp,data.values[index]])
+          workflow.S = incremental ? entries.concat(workflow.S) : entries
+          workflow.traceCursor = data.cursor
           setTimeout(callback,1)
        })
        .catch(error => {
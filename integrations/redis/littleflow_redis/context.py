@@ -1,27 +1,82 @@
 import json
 import os
+import time
+import threading
 
 import redis
+from littleflow import Flow, FlowStore
 
 class RedisOutputCache:
 
-   def __init__(self,client,prefix):
+   def __init__(self,client,prefix,local=False):
       self._client = client
       self._prefix = prefix
+      self._local = local
+      self._pipeline = None
+      self._values = {}
 
-   def get(self,index,default=None):
-      key = f'{self._prefix}:output:{index}'
-
-      # retrieve current value
-      value = self._client.get(key)
+   @property
+   def pipeline(self):
+      """
+      When set, writes are queued on the pipeline and reads of values written
+      since are served locally until the pipeline is replaced.
+      """
+      return self._pipeline
+
+   @pipeline.setter
+   def pipeline(self,value):
+      self._pipeline = value
+      if not self._local:
+         self._values = {}
 
-      if value is None:
-         return default
+   @property
+   def local(self):
+      """
+      Indicates whether values read or written are also kept in a local
+      write-through cache.
+      """
+      return self._local
 
-      # if there is a current value, decode
-      value = json.loads(value.decode('UTF-8'))
+   @property
+   def key(self):
+      """
+      The key of the hash that stores every output of the workflow.
+      """
+      return f'{self._prefix}:outputs'
+
+   def key_for(self,index):
+      """
+      The key of an output stored before outputs were kept in a single hash.
+      """
+      return f'{self._prefix}:output:{index}'
 
-      return value
+   def get(self,index,default=None):
+      return self.get_many([index],default=default)[0]
+
+   def get_many(self,indices,default=None):
+      """
+      Returns the values for a sequence of indices, retrieving any that are
+      not available locally in a single round trip. Outputs stored before
+      the hash was used are only looked up for indices missing from it.
+      """
+      indices = [int(index) for index in indices]
+      raw = [self._values.get(index) for index in indices]
+      missing = [position for position, value in enumerate(raw) if value is None]
+      if len(missing)>0:
+         hashed = self._client.hmget(self.key,[indices[position] for position in missing])
+         for position, value in zip(missing,hashed):
+            raw[position] = value
+         # outputs of workflows started before the hash was used
+         missing = [position for position in missing if raw[position] is None]
+         if len(missing)>0:
+            legacy = self._client.mget([self.key_for(indices[position]) for position in missing])
+            for position, value in zip(missing,legacy):
+               raw[position] = value
+         if self._local:
+            for position, value in enumerate(raw):
+               if value is not None:
+                  self._values[indices[position]] = value
+      return [json.loads(value.decode('UTF-8')) if value is not None else default for value in raw]
 
    def __getitem__(self,index):
       value = self.get(index)
@@ -32,25 +87,63 @@ class RedisOutputCache:
    def __setitem__(self,index,value):
       if not isinstance(value,dict) and not isinstance(value,list):
          raise ValueError(f'Incompatible type {type(value)}')
-      key = f'{self._prefix}:output:{index}'
-      self._client.set(key,json.dumps(value))
+      value = json.dumps(value).encode('UTF-8')
+      if self._pipeline is not None:
+         self._pipeline.hset(self.key,index,value)
+      else:
+         self._client.hset(self.key,index,value)
+      if self._pipeline is not None or self._local:
+         self._values[int(index)] = value
+
+class RedisFlowStore(FlowStore):
+   """
+   Stores compiled flows, keyed by the hash of their source, in Redis.
+   """
+
+   def __init__(self,client,prefix='littleflow:flow:',expiry=None):
+      self._client = client
+      self._prefix = prefix
+      self._expiry = expiry
+
+   def get(self,key):
+      value = self._client.get(self._prefix+key)
+      if value is None:
+         return None
+      return Flow.from_bytes(value)
+
+   def set(self,key,flow):
+      self._client.set(self._prefix+key,flow.to_bytes(),ex=self._expiry)
+
+def metadata_ttl():
+   return float(os.environ.get('LITTLEFLOW_METADATA_TTL',60))
+
+def metadata_watch():
+   return os.environ.get('LITTLEFLOW_METADATA_WATCH','false').lower() in ['true','1','yes']
 
 class MetadataService:
 
-   def getService(host=None,port=None,username=None,password=None,prefix=None,environ='global'):
-      connection_host = host if host is not None else os.environ.get('REDIS_HOST','0.0.0.0')
-      connection_port = int(port if port is not None else os.environ.get('REDIS_PORT',6379))
-      connection_username = username if username is not None else os.environ.get('REDIS_USERNAME')
-      connection_password = password if password is not None else os.environ.get('REDIS_PASSWORD')
-      pool = redis.ConnectionPool(host=connection_host,port=connection_port,username=connection_username,password=connection_password)
-      return MetadataService(pool,prefix=prefix,environ=environ)
+   PREFIX_KEY = 'littleflow:config:env-prefix'
 
-   def __init__(self,pool,prefix=None,environ='global'):
+   def getService(host=None,port=None,username=None,password=None,prefix=None,environ='global',pool=None,ttl=None):
+      if pool is None:
+         connection_host = host if host is not None else os.environ.get('REDIS_HOST','0.0.0.0')
+         connection_port = int(port if port is not None else os.environ.get('REDIS_PORT',6379))
+         connection_username = username if username is not None else os.environ.get('REDIS_USERNAME')
+         connection_password = password if password is not None else os.environ.get('REDIS_PASSWORD')
+         pool = redis.ConnectionPool(host=connection_host,port=connection_port,username=connection_username,password=connection_password)
+      return MetadataService(pool,prefix=prefix,environ=environ,ttl=ttl)
+
+   def __init__(self,pool,prefix=None,environ='global',ttl=None):
       self._pool = pool
+      self._connection = redis.Redis(connection_pool=pool)
       self._prefix = prefix
       self._environ = environ
       if self._environ is None:
          self._environ = 'global'
+      self._ttl = ttl if ttl is not None else metadata_ttl()
+      self._values = {}
+      self._lock = threading.Lock()
+      self._watcher = None
 
    @property
    def environ(self):
@@ -60,26 +153,80 @@ class MetadataService:
    def pool(self):
       return self._pool
 
+   @property
+   def ttl(self):
+      """
+      The number of seconds a value is cached locally (zero disables caching)
+      """
+      return self._ttl
+
    @property
    def prefix(self):
       prefix = self._prefix
       if prefix is None:
-         prefix = self.connection.get('littleflow:config:env-prefix')
+         prefix = self._cached(MetadataService.PREFIX_KEY)
       return prefix if prefix is not None else ''
 
    @property
    def connection(self):
-      return redis.Redis(connection_pool=self.pool)
+      return self._connection
+
+   def _cached(self,key):
+      now = time.monotonic()
+      with self._lock:
+         entry = self._values.get(key)
+      if entry is not None and entry[1]>now:
+         return entry[0]
+      value = self.connection.get(key)
+      if value is not None:
+         value = value.decode('utf-8')
+      if self._ttl>0:
+         with self._lock:
+            self._values[key] = (value,now+self._ttl)
+      return value
+
+   def invalidate(self,key=None):
+      """
+      Removes a key, or all keys when not specified, from the local cache.
+      """
+      with self._lock:
+         if key is None or key==MetadataService.PREFIX_KEY:
+            self._values.clear()
+         else:
+            self._values.pop(key,None)
+
+   def watch(self,sleep_time=1.0):
+      """
+      Invalidates locally cached values when their keys change by subscribing
+      to keyspace notifications in a background thread. The Redis server must
+      have keyspace notifications enabled (e.g., notify-keyspace-events K$g).
+      """
+      if self._watcher is not None:
+         return self._watcher
+      def on_change(message):
+         channel = message['channel']
+         if type(channel)==bytes:
+            channel = channel.decode('utf-8')
+         _, _, key = channel.partition('__:')
+         self.invalidate(key)
+      pubsub = self.connection.pubsub(ignore_subscribe_messages=True)
+      pubsub.psubscribe(**{
+         '__keyspace@*__:*env:*' : on_change,
+         f'__keyspace@*__:{MetadataService.PREFIX_KEY}' : on_change
+      })
+      self._watcher = pubsub.run_in_thread(sleep_time=sleep_time,daemon=True)
+      return self._watcher
+
+   def unwatch(self):
+      if self._watcher is not None:
+         self._watcher.stop()
+         self._watcher = None
 
    def get(self,name,environ=None,default=None):
       key = f'{self.prefix}env:{self._environ if environ is None else environ}:{name}'
-      value = self.connection.get(key)
-      if value is None:
-         return default
-      else:
-         return value.decode('utf-8')
+      value = self._cached(key)
+      return value if value is not None else default
 
    def __getitem__(self,name):
       key = f'{self.prefix}env:{self._environ}:{name}'
-      value = self.connection.get(key)
-      return value.decode('utf-8') if value is not None else None
+      return self._cached(key)
@@ -1,12 +1,16 @@
+import os
 import sys
 from datetime import datetime, timezone
 import json
 from uuid import uuid4
 import logging
+from contextlib import contextmanager
 
 import numpy as np
+import redis
 from littleflow import Parser, Compiler, Runner, Context, FunctionTaskContext, Flow
 from rqse import EventClient, EventListener, message, receipt_for
+from rqse.client import encode_dictionary
 
 from .context import RedisOutputCache
 
@@ -17,12 +21,93 @@ def workflow_state(client,key,default=None):
    value = client.get(key+':state')
    return value.decode('UTF-8') if value is not None else default
 
+def drain_endings():
+   """
+   Whether the queued ending vectors are summed into a single transition, as
+   set by the LITTLEFLOW_DRAIN_ENDINGS environment variable.
+   """
+   return os.environ.get('LITTLEFLOW_DRAIN_ENDINGS','false').lower() in ['true','1','yes']
+
+def workflow_states(client,keys,default=None):
+   """
+   Returns the states of several workflows with a single MGET.
+   """
+   if len(keys)==0:
+      return []
+   values = client.mget([key+':state' for key in keys])
+   return [value.decode('UTF-8') if value is not None else default for value in values]
+
 def set_workflow_state(client,key,value):
    return client.set(key+':state',value)
 
 def is_running(client,key):
    return workflow_state(client,key)=='RUNNING'
 
+def format_vector(V):
+   return ' '.join(map(str,np.asarray(V).flatten().tolist()))
+
+def snapshot_key(key):
+   return key+':current'
+
+def append_vector(client,key,V,pipeline=None):
+   """
+   Appends a change vector to the trace at key and, in the same transaction,
+   adds it to the current value snapshot of the vector. If a pipeline is
+   given, the commands are queued on it instead of executed.
+   """
+   V = np.asarray(V).flatten()
+   execute = pipeline is None
+   if execute:
+      pipeline = client.pipeline(transaction=True)
+   pipeline.lpush(key,str(tstamp())+' '+format_vector(V))
+   snapshot = snapshot_key(key)
+   for index in np.flatnonzero(V).tolist():
+      pipeline.hincrby(snapshot,index,int(V[index]))
+   if execute:
+      pipeline.execute()
+
+def set_vector_snapshot(client,key,V):
+   """
+   Replaces the current value snapshot of the vector at key.
+   """
+   pipeline = client.pipeline(transaction=True)
+   replace_vector_snapshot(pipeline,key,V)
+   pipeline.execute()
+
+def replace_vector_snapshot(pipeline,key,V):
+   V = np.asarray(V).flatten()
+   snapshot = snapshot_key(key)
+   mapping = {'size':V.shape[0]}
+   for index in np.flatnonzero(V).tolist():
+      mapping[index] = int(V[index])
+   pipeline.delete(snapshot)
+   pipeline.hset(snapshot,mapping=mapping)
+
+def current_vector(client,key):
+   """
+   Returns the current value of the vector at key from its snapshot. If the
+   snapshot was never initialized (e.g., a workflow started before snapshots
+   existed), the value is computed from the trace and the snapshot rebuilt.
+   """
+   values = client.hgetall(snapshot_key(key))
+   size = values.pop(b'size',None)
+   if size is not None:
+      V = np.zeros((int(size),1),dtype=int)
+      for index, value in values.items():
+         V[int(index)] = int(value)
+      return V
+   with client.pipeline(transaction=True) as pipeline:
+      try:
+         pipeline.watch(key)
+         V = compute_vector(pipeline,key)
+         if V is not None:
+            pipeline.multi()
+            replace_vector_snapshot(pipeline,key,V)
+            pipeline.execute()
+      except redis.WatchError:
+         logging.debug(f'The trace {key} changed while rebuilding its snapshot')
+   return V
+
 class RemoteTaskContext(FunctionTaskContext):
 
    def __init__(self,event_client,workflow_id,lookup={}):
@@ -48,7 +133,10 @@ class RemoteTaskContext(FunctionTaskContext):
 
       logging.info(f'Workflow {self._workflow_id} starting {invocation.name} ({invocation.index}) as {event["base"]}')
 
-      self._client.append(message(event,kind='start-task'))
+      if isinstance(context,RedisContext):
+         context.append(message(event,kind='start-task'))
+      else:
+         self._client.append(message(event,kind='start-task'))
 
       starting = context.new_transition()
       starting[invocation.index] = 1
@@ -62,34 +150,61 @@ class RedisContext(Context):
       self._key_A = key + ':A'
       self._key_S = key + ':S'
       self._workflow_id = workflow_id
+      self._pipeline = None
+
+   @contextmanager
+   def unit_of_work(self):
+      """
+      Buffers every write made by the context, its task context, and its
+      output cache within the block and sends them as a single transaction
+      when the block exits. If the block raises an exception, nothing is
+      written.
+      """
+      self._pipeline = self._client.connection.pipeline(transaction=True)
+      if isinstance(self.cache,RedisOutputCache):
+         self.cache.pipeline = self._pipeline
+      try:
+         yield self
+         self._pipeline.execute()
+      finally:
+         self._pipeline.reset()
+         self._pipeline = None
+         if isinstance(self.cache,RedisOutputCache):
+            self.cache.pipeline = None
+
+   def append(self,data):
+      """
+      Appends an event to the stream, buffered if within a unit of work.
+      """
+      if self._pipeline is None:
+         self._client.append(data)
+      else:
+         self._pipeline.xadd(self._client._stream_key,encode_dictionary(data))
 
    def accumulate(self,A):
       if (1*A).sum()>0:
-         self._client.connection.lpush(self._key_A,str(tstamp())+' '+str(A.flatten())[1:-1])
+         append_vector(self._client.connection,self._key_A,A,pipeline=self._pipeline)
 
    def start(self,N):
       client = self._client.connection
       if not is_running(client,self._key):
          return
       starting = 1*N
-      client.lpush(self._key_S,str(tstamp())+' '+str(starting.flatten())[1:-1])
+      append_vector(client,self._key_S,starting,pipeline=self._pipeline)
       super().start(N)
       A = - starting * self.T
-      client.lpush(self._key_A,str(tstamp())+' '+str(A.flatten())[1:-1])
+      append_vector(client,self._key_A,A,pipeline=self._pipeline)
 
    def end(self,N):
       ending = - 1*N
-      self._client.connection.lpush(self._key_S,str(tstamp())+' '+str(ending.flatten())[1:-1])
+      append_vector(self._client.connection,self._key_S,ending,pipeline=self._pipeline)
       super().end(N)
 
    def ended(self,value):
-      self._client.append(message({'workflow':self._workflow_id },kind='end-workflow'))
+      self.append(message({'workflow':self._workflow_id },kind='end-workflow'))
 
 def workflow_archive(client,key):
-   value = client.get(key)
-   if value is None:
-      raise IOError(f'No workflow value at {key}')
-   object = json.loads(value.decode('UTF-8'))
+   _, object = load_workflow(client,key,return_json=True)
    object['S'] = [ [tstamp.isoformat(),v.flatten().tolist()] for tstamp, v in trace_vector(client,key+':S')]
    object['A'] = [ [tstamp.isoformat(),v.flatten().tolist()] for tstamp, v in trace_vector(client,key+':A')]
    return object
@@ -97,11 +212,11 @@ def workflow_archive(client,key):
 def restart_workflow(event_client,key,workflow_id):
    client = event_client.connection
    s_key = key+':S'
-   S = compute_vector(client,s_key)
-   if S.sum()>0:
+   S = current_vector(client,s_key)
+   if S is not None and S.sum()>0:
       # Make an adjusment to S to take it back to zero
       ending = - S
-      client.lpush(s_key,str(tstamp())+' '+str(ending.flatten())[1:-1])
+      append_vector(client,s_key,ending)
 
       # ensure S is a zero/one vector
       S = S>0
@@ -112,12 +227,12 @@ def restart_workflow(event_client,key,workflow_id):
 
       # reload the context
       context = load_workflow_state(event_client, key, workflow_id)
-      context.start(S)
-
       # run the algorithm forward
-      runner = Runner()
-      while not context.ending.empty():
-         runner.next(context,context.ending.get())
+      runner = Runner(drain=drain_endings())
+      with context.unit_of_work():
+         context.start(S)
+         while not context.ending.empty():
+            runner.advance(context)
 
       return True
    else:
@@ -128,15 +243,19 @@ def restore_workflow(client,key,archive,workflows_key=None):
    del archive['S']
    A = archive['A']
    del archive['A']
-   client.set(key,json.dumps(archive))
+   save_workflow(client,Flow(serialized=archive),key)
    skey = key + ':S'
    started = np.zeros(len(archive['T']),dtype=int)
    for tstamp, v in reversed(S):
       started += np.array(v)
       client.lpush(skey,tstamp+' '+' '.join(map(str,v)))
+   set_vector_snapshot(client,skey,started)
    akey = key + ':A'
+   activation = np.zeros(len(archive['T']),dtype=int)
    for tstamp, v in reversed(A):
+      activation += np.array(v)
       client.lpush(akey,tstamp+' '+' '.join(map(str,v)))
+   set_vector_snapshot(client,akey,activation)
    set_workflow_state(client,key,'TERMINATED')
    if workflows_key is not None:
       client.lpush(workflows_key,key)
@@ -144,14 +263,18 @@ def restore_workflow(client,key,archive,workflows_key=None):
 
 
 def save_workflow(client,flow,key):
-   client.set(key,str(flow))
+   client.set(key,flow.to_bytes())
 
 def load_workflow(client,key,return_json=False):
    value = client.get(key)
    if value is None:
       raise IOError(f'No workflow value at {key}')
-   raw_workflow = value.decode('UTF-8')
    logging.debug(f'Restoring workflow from {key}')
+   if Flow.is_bytes(value):
+      f = Flow.from_bytes(value)
+      return f if not return_json else (f,f.save())
+   # workflows saved before the binary format are JSON
+   raw_workflow = value.decode('UTF-8')
    logging.debug(raw_workflow)
    object = json.loads(raw_workflow)
    f = Flow(serialized=object)
@@ -181,6 +304,44 @@ def trace_vector(client,key):
          result = np.fromstring(repl,dtype=int,sep=' ')
          yield datetime.fromisoformat(tstamp), result
 
+def read_trace(client,key,cursor=0,since=None,page_size=500):
+   """
+   Reads the entries of a trace that are newer than a cursor or timestamp,
+   newest first. The cursor is the number of entries already read; as
+   entries are only ever pushed onto the head of the list, the unread
+   entries are a single range relative to its tail. Returns the timestamps,
+   the vectors as the rows of a matrix, and the cursor for the next read.
+   A timestamp without a timezone is taken to be UTC.
+   """
+   if since is not None and since.tzinfo is None:
+      since = since.replace(tzinfo=timezone.utc)
+   if since is None:
+      response = client.lrange(key,0,-(cursor+1))
+   else:
+      response = []
+      current = 0
+      done = False
+      while not done:
+         page = client.lrange(key,current,current+page_size-1)
+         current += page_size
+         for value in page:
+            tstamp, _, _ = value.partition(b' ')
+            if datetime.fromisoformat(tstamp.decode('UTF-8'))<=since:
+               done = True
+               break
+            response.append(value)
+         done = done or len(page)<page_size
+   timestamps = []
+   vectors = []
+   for value in response:
+      tstamp, _, repl = value.decode('UTF-8').partition(' ')
+      timestamps.append(tstamp)
+      vectors.append(repl)
+   count = len(vectors)
+   values = np.fromstring(' '.join(vectors),dtype=int,sep=' ').reshape(count,-1) if count>0 else np.zeros((0,0),dtype=int)
+   next_cursor = cursor + count if since is None else client.llen(key)
+   return timestamps, values, next_cursor
+
 def compute_vector(client,key):
    result = None
    current = 0
@@ -205,16 +366,19 @@ def load_workflow_state(event_client,key,workflow_id):
    remote_context = RemoteTaskContext(event_client,workflow_id)
    client = event_client.connection
    flow = load_workflow(client,key)
-   S = compute_vector(client,key+':S')
-   A = compute_vector(client,key+':A')
-   context = RedisContext(flow,event_client,key,workflow_id,state=S,activation=A,cache=RedisOutputCache(client,key),task_context=remote_context)
+   S = current_vector(client,key+':S')
+   A = current_vector(client,key+':A')
+   context = RedisContext(flow,event_client,key,workflow_id,state=S,activation=A,cache=RedisOutputCache(client,key,local=True),task_context=remote_context)
    return context
 
-def run_workflow(workflow,event_client,input=None,workflow_id=None,prefix=''):
-   p = Parser()
-   c = Compiler()
-   model = p.parse(workflow)
-   flow = c.compile(model)
+def run_workflow(workflow,event_client,input=None,workflow_id=None,prefix='',cache=None):
+   if cache is not None:
+      flow = cache.compile(workflow)
+   else:
+      p = Parser()
+      c = Compiler()
+      model = p.parse(workflow)
+      flow = c.compile(model)
 
    if workflow_id is None:
       workflow_id = f'workflow:{flow.name+"-" if flow.name is not None else ""}{str(uuid4())}'
@@ -226,20 +390,23 @@ def run_workflow(workflow,event_client,input=None,workflow_id=None,prefix=''):
    redis_client.delete(key)
    redis_client.delete(key+':A')
    redis_client.delete(key+':S')
+   set_vector_snapshot(redis_client,key+':A',np.zeros(len(flow),dtype=int))
+   set_vector_snapshot(redis_client,key+':S',np.zeros(len(flow),dtype=int))
 
    remote_context = RemoteTaskContext(event_client,workflow_id)
-   context = RedisContext(flow,event_client,key,workflow_id,cache=RedisOutputCache(redis_client,key),task_context=remote_context)
+   context = RedisContext(flow,event_client,key,workflow_id,cache=RedisOutputCache(redis_client,key,local=True),task_context=remote_context)
 
    save_workflow(redis_client,flow,key)
    set_workflow_state(redis_client,key,'RUNNING')
 
    event_client.append(message({'workflow':workflow_id},kind='start-workflow'))
 
-   runner = Runner()
-   runner.start(context,input=input)
+   runner = Runner(drain=drain_endings())
+   with context.unit_of_work():
+      runner.start(context,input=input)
 
-   while not context.ending.empty():
-      runner.next(context,context.ending.get())
+      while not context.ending.empty():
+         runner.advance(context)
 
    return workflow_id
 
@@ -345,9 +512,10 @@ class TaskEndListener(EventListener):
 
          context.ending.put(ended)
 
-         runner = Runner()
-         while not context.ending.empty():
-            runner.next(context,context.ending.get())
+         runner = Runner(drain=drain_endings())
+         with context.unit_of_work():
+            while not context.ending.empty():
+               runner.advance(context)
       else:
 
          failures = get_failures(self.connection,key)
@@ -382,20 +550,18 @@ def delete_workflow(client,key,workflows_key=None):
       size = flow.F.shape[0]
    except IOError as ex:
       pass
-   client.delete(key)
-   client.delete(key+':A')
-   client.delete(key+':S')
-   client.delete(key+':state')
-   client.delete(key+':FAILED')
+   cache = RedisOutputCache(client,key)
+   keys = [key,key+':A',key+':S',snapshot_key(key+':A'),snapshot_key(key+':S'),key+':state',key+':FAILED',cache.key]
+   if size>=0:
+      # outputs of workflows started before the hash was used
+      keys += [cache.key_for(index) for index in range(-1,size)]
+   client.delete(*keys)
    if workflows_key is not None:
       client.lrem(workflows_key,0,key)
-   client.delete(f'{key}:output:-1')
    if size<0:
       found = True
       index = 0
+      client.delete(cache.key_for(-1))
       while found:
-         found = client.delete(f'{key}:output:{index}')>0
+         found = client.delete(cache.key_for(index))>0
          index += 1
-   else:
-      for index in range(size):
-         client.delete(f'{key}:output:{index}')
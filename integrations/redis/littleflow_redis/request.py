@@ -1,13 +1,21 @@
+import os
 import logging
-from urllib.parse import urljoin
+import threading
+import asyncio
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
 import json
+from dataclasses import dataclass, field
 
 import requests 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from rqse import EventListener, message, receipt_for
 from littleflow import merge
 
-from .context import RedisOutputCache, MetadataService
+from .context import RedisOutputCache, MetadataService, metadata_watch
 
 def value_for(input,parameters,name,default=None):
    return input.get(name,parameters.get(name,default)) if input is not None else parameters.get(name,default) if parameters is not None else default
@@ -23,11 +31,87 @@ class jsondict(dict):
          copy[key] = value
       return copy
 
-class RequestTaskListener(EventListener):
+@dataclass
+class RequestTask:
+   workflow_id : str
+   index : int
+   name : str
+   method : str
+   url : str
+   input : 'typing.Any' = None
+   parameters : 'typing.Any' = None
+   template : str = None
+   content_type : str = 'application/json'
+   output_modes : list = field(default_factory=list)
+   sync : bool = True
+   error_on_status : bool = True
+   event_id : str = None
+
+class RequestSessions:
+   """
+   Pooled keep-alive HTTP sessions, one per scheme and host, so that requests
+   to the same service reuse connections. The defaults are taken from the
+   LITTLEFLOW_REQUEST_POOL_SIZE, LITTLEFLOW_REQUEST_TIMEOUT,
+   LITTLEFLOW_REQUEST_RETRIES, and LITTLEFLOW_REQUEST_BACKOFF environment
+   variables. Retries only apply to idempotent methods.
+   """
+
+   def __init__(self,pool_size=None,timeout=None,retries=None,backoff=None,retry_status=(502,503,504)):
+      self._pool_size = pool_size if pool_size is not None else int(os.environ.get('LITTLEFLOW_REQUEST_POOL_SIZE',10))
+      timeout = timeout if timeout is not None else os.environ.get('LITTLEFLOW_REQUEST_TIMEOUT')
+      self._timeout = float(timeout) if timeout is not None else None
+      self._retries = retries if retries is not None else int(os.environ.get('LITTLEFLOW_REQUEST_RETRIES',0))
+      self._backoff = backoff if backoff is not None else float(os.environ.get('LITTLEFLOW_REQUEST_BACKOFF',0.5))
+      self._retry_status = retry_status
+      self._sessions = {}
+      self._lock = threading.Lock()
+
+   @property
+   def timeout(self):
+      return self._timeout
+
+   def session_for(self,url):
+      parts = urlsplit(url)
+      origin = f'{parts.scheme}://{parts.netloc}'
+      session = self._sessions.get(origin)
+      if session is None:
+         with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+               session = requests.Session()
+               retry = Retry(total=self._retries,backoff_factor=self._backoff,status_forcelist=self._retry_status,raise_on_status=False)
+               adapter = HTTPAdapter(pool_connections=1,pool_maxsize=self._pool_size,max_retries=retry)
+               session.mount(parts.scheme+'://',adapter)
+               self._sessions[origin] = session
+      return session
+
+   def request(self,method,url,**kwargs):
+      if 'timeout' not in kwargs:
+         kwargs['timeout'] = self._timeout
+      return self.session_for(url).request(method,url,**kwargs)
+
+   def close(self):
+      with self._lock:
+         for session in self._sessions.values():
+            session.close()
+         self._sessions = {}
 
-   def __init__(self,key,credential_actor=None,group='request',host='0.0.0.0',port=6379,username=None,password=None,pool=None):
+class RequestTaskListener(EventListener):
+   """
+   A listener that sends HTTP requests for request tasks. The metadata for
+   each environment is cached for LITTLEFLOW_METADATA_TTL seconds. When
+   watch_metadata is true (the default is taken from the
+   LITTLEFLOW_METADATA_WATCH environment variable), the cached values are
+   also invalidated by keyspace notifications while the listener runs.
+   """
+
+   def __init__(self,key,credential_actor=None,group='request',host='0.0.0.0',port=6379,username=None,password=None,pool=None,sessions=None,watch_metadata=None):
       super().__init__(key,group,select=['start-task'],host=host,port=port,username=username,password=password,pool=pool)
       self._credential_actor = credential_actor
+      self._sessions = sessions if sessions is not None else RequestSessions()
+      self._metadata = {}
+      self._watch_metadata = watch_metadata if watch_metadata is not None else metadata_watch()
+      self._watching = False
 
    def fail(self,workflow_id,index,name,reason=None):
       event = {'name':name,'index':index,'workflow':workflow_id,'status':'FAILURE'}
@@ -36,6 +120,35 @@ class RequestTaskListener(EventListener):
       self.append(message(event,kind='end-task'))
       return True
 
+   def metadata_for(self,environ):
+      """
+      Returns the metadata service for an environment. The services share the
+      listener's connection pool and are reused across tasks.
+      """
+      metadata = self._metadata.get(environ)
+      if metadata is None:
+         metadata = MetadataService.getService(environ=environ,pool=self.pool)
+         if self._watching:
+            metadata.watch()
+         self._metadata[environ] = metadata
+      return metadata
+
+   @property
+   def sessions(self):
+      return self._sessions
+
+   def onStart(self):
+      self._watching = self._watch_metadata
+      if self._watching:
+         for metadata in self._metadata.values():
+            metadata.watch()
+
+   def onStop(self):
+      self._watching = False
+      for metadata in self._metadata.values():
+         metadata.unwatch()
+      self._sessions.close()
+
    def output_for(self,workflow_id,index,output):
       if output is not None:
          cache = RedisOutputCache(self.connection,workflow_id)
@@ -43,6 +156,34 @@ class RequestTaskListener(EventListener):
 
    def process(self,event_id, event):
 
+      base = event.get('base')
+      name = event.get('name')
+      ns, _, task_name = base.partition(':') if base is not None else name.partition(':')
+      if ns!='request':
+         return False
+
+      self.append(receipt_for(event_id))
+
+      task = self.prepare(event)
+      if task is None:
+         return True
+      task.event_id = event_id
+
+      return self.dispatch(task)
+
+   def dispatch(self,task):
+      """
+      Runs a prepared task. Returns whether the start-task event can be
+      acknowledged.
+      """
+      return self.execute(task)
+
+   def prepare(self,event):
+      """
+      Prepares the HTTP request for a start-task event. Returns None if the
+      task has already been failed.
+      """
+
       is_debug = logging.DEBUG >= logging.getLogger().getEffectiveLevel()
 
       workflow_id = event.get('workflow')
@@ -50,18 +191,14 @@ class RequestTaskListener(EventListener):
       name = event.get('name')
       index = event.get('index')
       ns, _, task_name = base.partition(':') if base is not None else name.partition(':')
-      if ns!='request':
-         return False
 
       input = jsondict.copy_of(event.get('input'))
       parameters = jsondict.copy_of(event.get('parameters'))
 
-      self.append(receipt_for(event_id))
-
       sync = bool(value_for(input,parameters,'sync',True))
 
       environ = value_for(input,parameters,'environ')
-      metadata = MetadataService.getService(environ=environ)
+      metadata = self.metadata_for(environ)
 
       category = value_for({},parameters,'category',default='')
 
@@ -79,7 +216,8 @@ class RequestTaskListener(EventListener):
             url = url.format(input=input,parameters=parameters) 
          except Exception as ex:
             logging.error(f'Unable to format url "{url}" due to: {ex}')
-            return self.fail(workflow_id,index,name,f'Unabled to send request due to url format error on "{url}": {ex}')
+            self.fail(workflow_id,index,name,f'Unabled to send request due to url format error on "{url}": {ex}')
+            return None
 
       if base_url is not None:
          url = urljoin(base_url,url)
@@ -93,7 +231,8 @@ class RequestTaskListener(EventListener):
          content_type = content_type.format(input=input,parameters=parameters) 
       except Exception as ex:
          logging.error(f'Unable to format content_type "{content_type}" due to: {ex}')
-         return self.fail(workflow_id,index,name,f'Unabled to send request due to content_type format error on "{content_type}": {ex}')
+         self.fail(workflow_id,index,name,f'Unabled to send request due to content_type format error on "{content_type}": {ex}')
+         return None
       use_context_parameters = bool(value_for(input,parameters,'use_context_parameters',True))
       output_modes = value_for(input,parameters,'output_mode',[])
       if type(output_modes)==str:
@@ -101,10 +240,12 @@ class RequestTaskListener(EventListener):
       error_on_status = bool(value_for(input,parameters,'error_on_status',True))
 
       if task_name not in ['get','post','put','delete']:
-         return self.fail(workflow_id,index,name,f'Unrecognized wait task name {task_name}')
+         self.fail(workflow_id,index,name,f'Unrecognized wait task name {task_name}')
+         return None
 
       if url is None:
-         return self.fail(workflow_id,index,name,f'Unrecognized wait task name {task_name}')
+         self.fail(workflow_id,index,name,f'Unrecognized wait task name {task_name}')
+         return None
 
       if not sync and use_context_parameters:
          if url.rfind('?')<0:
@@ -116,6 +257,24 @@ class RequestTaskListener(EventListener):
          url += f'&littleflow-index={index}'
          url += f'&littleflow-workflow={workflow_id}'
 
+      return RequestTask(workflow_id,index,name,task_name,url,input,parameters,template,content_type,output_modes,sync,error_on_status)
+
+   def execute(self,task):
+      """
+      Sends the request for a prepared task, stores the output, and ends
+      the task.
+      """
+
+      is_debug = logging.DEBUG >= logging.getLogger().getEffectiveLevel()
+
+      workflow_id = task.workflow_id
+      index = task.index
+      name = task.name
+      task_name = task.method
+      url = task.url
+      input = task.input
+      parameters = task.parameters
+
       if is_debug:
          logging.debug(f'HTTP {task_name.upper()} request on {url}')
 
@@ -125,32 +284,32 @@ class RequestTaskListener(EventListener):
             headers['Authorization'] = f'Bearer {self._credential_actor(input,parameters)}'
             if is_debug:
                logging.debug(f'Authorization: {headers["Authorization"]}')
-         data = template.format(input=input,parameters=parameters) if template is not None else json.dumps(input)
+         data = task.template.format(input=input,parameters=parameters) if task.template is not None else json.dumps(input)
          if is_debug and data is not None:
             logging.debug("Request data:")
             logging.debug(data)
          if task_name=='get':
-            response = requests.get(url,headers=headers)
+            response = self._sessions.request('GET',url,headers=headers)
          elif task_name=='post':
-            headers['Content-Type'] = content_type
-            response = requests.post(url,headers=headers,data=data if data is not None else '')
+            headers['Content-Type'] = task.content_type
+            response = self._sessions.request('POST',url,headers=headers,data=data if data is not None else '')
          elif task_name=='put':
-            headers['Content-Type'] = content_type
-            response = requests.put(url,headers=headers,data=data if data is not None else '')
+            headers['Content-Type'] = task.content_type
+            response = self._sessions.request('PUT',url,headers=headers,data=data if data is not None else '')
          elif task_name=='delete':
-            response = requests.delete(url)
+            response = self._sessions.request('DELETE',url)
 
          if is_debug:
             logging.debug(f'{response.status_code} response for {url}')
             logging.debug(response.text)
 
-         if error_on_status and (response.status_code<200 or response.status_code>=300):
+         if task.error_on_status and (response.status_code<200 or response.status_code>=300):
             return self.fail(workflow_id,index,name,f'Request failed ({response.status_code}): {response.text}')
 
 
          try:
             output = input
-            for mode in output_modes:
+            for mode in task.output_modes:
                if output is None:
                   output = {}
                if mode=='status':
@@ -170,7 +329,7 @@ class RequestTaskListener(EventListener):
 
          self.output_for(workflow_id,index,output)
 
-         if sync:
+         if task.sync:
             event = {'name':name,'index':index,'workflow':workflow_id}
             self.append(message(event,kind='end-task'))
 
@@ -180,3 +339,143 @@ class RequestTaskListener(EventListener):
          logging.exception(ex)
          logging.error(f'Unabled to send {name} due to exception.')
          return self.fail(workflow_id,index,name,f'Unabled to send request due to exception: {ex}')
+
+class AsyncRequestTaskListener(RequestTaskListener):
+   """
+   A request task listener that sends requests concurrently. Requests run on
+   an event loop in a background thread with at most max_in_flight requests
+   outstanding and at most max_per_host requests to any one host. When the
+   limit is reached, the listener stops reading events until a request
+   completes. The defaults are taken from the LITTLEFLOW_REQUEST_CONCURRENCY
+   and LITTLEFLOW_REQUEST_HOST_CONCURRENCY environment variables.
+   The start-task events are only acknowledged once their request has
+   completed so that requests in flight are redelivered if the worker stops.
+   A pending event claimed again while its request is in flight is not
+   dispatched twice. Requests time out after LITTLEFLOW_REQUEST_TIMEOUT
+   seconds (30 by default).
+   """
+
+   def __init__(self,key,credential_actor=None,group='request',host='0.0.0.0',port=6379,username=None,password=None,pool=None,sessions=None,max_in_flight=None,max_per_host=None,watch_metadata=None):
+      self._max_in_flight = max_in_flight if max_in_flight is not None else int(os.environ.get('LITTLEFLOW_REQUEST_CONCURRENCY',32))
+      self._max_per_host = max_per_host if max_per_host is not None else int(os.environ.get('LITTLEFLOW_REQUEST_HOST_CONCURRENCY',8))
+      if sessions is None:
+         sessions = RequestSessions(pool_size=max(self._max_per_host,int(os.environ.get('LITTLEFLOW_REQUEST_POOL_SIZE',10))),timeout=float(os.environ.get('LITTLEFLOW_REQUEST_TIMEOUT',30)))
+      super().__init__(key,credential_actor=credential_actor,group=group,host=host,port=port,username=username,password=password,pool=pool,sessions=sessions,watch_metadata=watch_metadata)
+      self._slots = threading.BoundedSemaphore(self._max_in_flight)
+      self._hosts = {}
+      self._loop = None
+      self._loop_thread = None
+      self._executor = None
+      self._in_flight = set()
+      self._event_ids = set()
+      self._lock = threading.Lock()
+
+   @property
+   def max_in_flight(self):
+      return self._max_in_flight
+
+   @property
+   def max_per_host(self):
+      return self._max_per_host
+
+   @property
+   def in_flight(self):
+      """
+      The number of requests that have been dispatched but not completed
+      """
+      return len(self._in_flight)
+
+   def start_executor(self):
+      with self._lock:
+         if self._loop is not None:
+            return
+         self._executor = ThreadPoolExecutor(max_workers=self._max_in_flight,thread_name_prefix='littleflow-request')
+         self._loop = asyncio.new_event_loop()
+         self._loop.set_default_executor(self._executor)
+         self._loop_thread = threading.Thread(target=self._loop.run_forever,daemon=True)
+         self._loop_thread.start()
+
+   def onStart(self):
+      super().onStart()
+      self.start_executor()
+
+   def host_limit(self,url):
+      # only called on the event loop thread
+      netloc = urlsplit(url).netloc
+      semaphore = self._hosts.get(netloc)
+      if semaphore is None:
+         semaphore = asyncio.Semaphore(self._max_per_host)
+         self._hosts[netloc] = semaphore
+      return semaphore
+
+   async def send(self,task):
+      async with self.host_limit(task.url):
+         return await asyncio.get_running_loop().run_in_executor(None,self.execute,task)
+
+   def _completed(self,task,future):
+      with self._lock:
+         self._in_flight.discard(future)
+      self._slots.release()
+      if not future.cancelled():
+         if future.exception() is not None:
+            logging.error(f'Request task failed: {future.exception()}')
+         elif future.result() and task.event_id is not None:
+            # the event is only acknowledged once the request has completed
+            self.acknowledge(task.event_id,{'kind':'start-task'})
+      with self._lock:
+         self._event_ids.discard(task.event_id)
+
+   def submit(self,task):
+      """
+      Dispatches a prepared task, blocking while the maximum number of
+      requests are in flight. Returns None if the listener stops before a
+      request slot is available.
+      """
+      self.start_executor()
+      while not self._slots.acquire(timeout=self.wait):
+         if not self.listening:
+            return None
+         logging.debug(f'Waiting for one of {self._max_in_flight} request slots.')
+      future = asyncio.run_coroutine_threadsafe(self.send(task),self._loop)
+      with self._lock:
+         self._in_flight.add(future)
+      future.add_done_callback(lambda future : self._completed(task,future))
+      return future
+
+   def process(self,event_id, event):
+      with self._lock:
+         if event_id in self._event_ids:
+            # claimed again from the pending entries while still in flight
+            return False
+      return super().process(event_id,event)
+
+   def dispatch(self,task):
+      # the start-task event is acknowledged when the request completes
+      with self._lock:
+         self._event_ids.add(task.event_id)
+      if self.submit(task) is None:
+         with self._lock:
+            self._event_ids.discard(task.event_id)
+      return False
+
+   def drain(self,timeout=None):
+      """
+      Waits for the requests in flight to complete.
+      """
+      with self._lock:
+         pending = list(self._in_flight)
+      if len(pending)>0:
+         futures.wait(pending,timeout=timeout)
+
+   def onStop(self):
+      self.drain()
+      with self._lock:
+         loop, thread, executor = self._loop, self._loop_thread, self._executor
+         self._loop = self._loop_thread = self._executor = None
+         self._hosts = {}
+      if loop is not None:
+         loop.call_soon_threadsafe(loop.stop)
+         thread.join()
+         loop.close()
+         executor.shutdown(wait=True)
+      super().onStop()
@@ -9,9 +9,11 @@ from copy import deepcopy
 import builtins
 import importlib
 import logging
+from datetime import datetime, timezone
 
-from flask import Flask, request, jsonify, current_app, g, render_template_string
+from flask import Flask, request, jsonify, current_app, g, render_template_string, Response
 import yaml
+import numpy as np
 import redis
 import boto3
 from botocore.exceptions import ClientError
@@ -24,8 +26,8 @@ from apispec_webframeworks.flask import FlaskPlugin
 
 from pydantic import BaseModel
 
-from littleflow_redis import load_workflow, compute_vector, trace_vector, workflow_state, delete_workflow, terminate_workflow, workflow_archive, restart_workflow, restore_workflow, run_workflow, get_failures, RedisOutputCache
-from littleflow import graph
+from littleflow_redis import load_workflow, current_vector, read_trace, workflow_state, workflow_states, delete_workflow, terminate_workflow, workflow_archive, restart_workflow, restore_workflow, run_workflow, get_failures, RedisOutputCache
+from littleflow import graph, FlowCache
 
 from .message import StatusResponse, StatusCode, ServiceJSONProvider, VersionInfo, WorkflowId, ArchiveLocation, Location, WorkflowStart
 
@@ -91,6 +93,8 @@ class Config:
    WORKFLOWS_STREAM = 'workflows:run'
    WORKFLOWS_KEY = 'workflows:all'
    INPROGRESS_KEY = 'workflows:inprogress'
+   FLOW_CACHE_SIZE = 128
+   MAX_PAGE_SIZE = 1000
 
 service = Flask('api')
 service.config.from_object(Config())
@@ -134,6 +138,13 @@ def get_event_client():
       g.event_client = EventClient(current_app.config['WORKFLOWS_STREAM'],pool=get_pool())
    return g.event_client
 
+def get_flow_cache():
+   cache = current_app.extensions.get('littleflow_flow_cache')
+   if cache is None:
+      cache = FlowCache(size=int(current_app.config['FLOW_CACHE_SIZE']))
+      current_app.extensions['littleflow_flow_cache'] = cache
+   return cache
+
 # def message_response(status,message=None,data=None):
 #    return 
 #    msg = data.copy() if data is not None else {}
@@ -188,13 +199,38 @@ def index():
    """
    return jsonify(VersionInfo(littleflow=api_version[0],littleflow_redis=api_version[1]))
 
+def page_size(default=50):
+   size = int(request.args.get('size',default))
+   return max(1,min(size,current_app.config['MAX_PAGE_SIZE']))
+
 @service.route('/workflows',methods=['GET'])
 def workflows():
    """
    ---
    get:
       description: |-
-         Returns a list all the cached workflows
+         Returns a list all the cached workflows. The next page is linked
+         and is located by the last workflow returned so that newly started
+         workflows do not shift the pages. Locating the cursor is O(position)
+         in the list. When the cursor workflow is no longer in the list
+         (e.g., it was deleted), the page starts where the cursor was, one
+         before the next offset, as the later workflows have moved up.
+      parameters:
+       - name: cursor
+         in: query
+         schema:
+            type: string
+         description: The last workflow identifier of the previous page
+       - name: next
+         in: query
+         schema:
+            type: integer
+         description: The offset of the page when there is no cursor
+       - name: size
+         in: query
+         schema:
+            type: integer
+         description: The number of workflows to return
       responses:
          200:
             description: A list of workflow
@@ -206,14 +242,26 @@ def workflows():
                         type: string
    """
    client = get_redis()
-   start = int(request.args.get('next',0))
-   size = int(request.args.get('size',50))
-   items = client.lrange(current_app.config['WORKFLOWS_KEY'],start,start+size-1)
-   convert = lambda x : {'id':x[9:],'state':workflow_state(client,x,default='UNKNOWN')}
-   workflows = [convert(value.decode('UTF-8')) for value in items]
+   size = page_size()
+   workflows_key = current_app.config['WORKFLOWS_KEY']
+   cursor = request.args.get('cursor')
+   if cursor is not None:
+      # The cursor is the last workflow seen and so newly started
+      # workflows do not shift the page
+      position = client.lpos(workflows_key,'workflow:'+cursor)
+      if position is not None:
+         start = position+1
+      else:
+         # the workflows after a deleted cursor have each moved up by one
+         start = max(int(request.args.get('next',0))-1,0)
+   else:
+      start = int(request.args.get('next',0))
+   items = [value.decode('UTF-8') for value in client.lrange(workflows_key,start,start+size-1)]
+   states = workflow_states(client,items,default='UNKNOWN')
+   workflows = [{'id':key[9:],'state':state} for key, state in zip(items,states)]
    response =jsonify(workflows)
    if len(items)==size:
-      response.headers['Link'] = f'<{request.base_url}?next={start+size}>; rel="next"'
+      response.headers['Link'] = f'<{request.base_url}?next={start+size}&cursor={items[-1][9:]}&size={size}>; rel="next"'
    return response
 
 @service.route('/inprogress',methods=['GET'])
@@ -222,7 +270,26 @@ def inprogress():
    ---
    get:
       description: |-
-         Returns a list of currently cached workflows that are in progress
+         Returns a list of currently cached workflows that are in progress.
+         When a size or cursor is given, a page of the list is returned and
+         the next page is linked. When state is true, the workflow state is
+         included with each id.
+      parameters:
+       - name: cursor
+         in: query
+         schema:
+            type: integer
+         description: The cursor returned in the link to the next page
+       - name: size
+         in: query
+         schema:
+            type: integer
+         description: The number of workflows to return
+       - name: state
+         in: query
+         schema:
+            type: boolean
+         description: Whether to include the state of each workflow
       responses:
          200:
             description: A list of workflow ids
@@ -234,9 +301,23 @@ def inprogress():
                         type: string
    """
    client = get_redis()
-   items = client.smembers(current_app.config['INPROGRESS_KEY'])
-   workflows = [value.decode('UTF-8')[9:] for value in items]
-   return jsonify(workflows)
+   inprogress_key = current_app.config['INPROGRESS_KEY']
+   next_cursor = None
+   if 'cursor' in request.args or 'size' in request.args:
+      size = page_size()
+      next_cursor, items = client.sscan(inprogress_key,int(request.args.get('cursor',0)),count=size)
+   else:
+      items = client.smembers(inprogress_key)
+   items = [value.decode('UTF-8') for value in items]
+   if request.args.get('state','false').lower()=='true':
+      states = workflow_states(client,items,default='UNKNOWN')
+      workflows = [{'id':key[9:],'state':state} for key, state in zip(items,states)]
+   else:
+      workflows = [key[9:] for key in items]
+   response = jsonify(workflows)
+   if next_cursor:
+      response.headers['Link'] = f'<{request.base_url}?cursor={next_cursor}&size={size}>; rel="next"'
+   return response
 
 @service.route('/workflows/<workflow_id>',methods=['GET','DELETE'])
 def get_workflow(workflow_id):
@@ -398,14 +479,14 @@ def get_workflow_state(workflow_id):
    state = workflow_state(client,key)
    if state is None:
       state = 'UKNOWN'
-   S = compute_vector(client,key+':S')
-   A = compute_vector(client,key+':A')
+   S = current_vector(client,key+':S')
+   A = current_vector(client,key+':A')
    failures = get_failures(client,key)
    data = {'state':state, 'S':S.flatten().tolist() if S is not None else [], 'A': A.flatten().tolist() if A is not None else []}
    if failures is not None:
       data['failures'] = failures.flatten().tolist()
    cache = RedisOutputCache(client,key)
-   data['output'] = [cache.get(index,{}) for index in range(len(S))]
+   data['output'] = cache.get_many(range(len(S)),default={}) if S is not None else []
 
    return jsonify(data)
 
@@ -430,9 +511,28 @@ def get_workflow_trace(workflow_id,kind):
             - S
             - A
          description: The kind must be 'S' (state) or 'A' (activation)
+       - name: cursor
+         in: query
+         schema:
+            type: integer
+         description: The cursor from a previous response; only newer entries are returned
+       - name: since
+         in: query
+         schema:
+            type: string
+         description: An ISO 8601 timestamp (UTC when no offset is given); only newer entries are returned
+       - name: format
+         in: query
+         schema:
+            type: string
+            enum:
+            - rows
+            - columns
+            - binary
+         description: Whether the trace is returned as an array of rows, as columns, or as a numpy .npz archive of timestamps and values
       responses:
          200:
-            description: A trace array
+            description: A trace array, newest entry first. The cursor for the next request is returned in the X-Trace-Cursor header.
             content:
                'application/json':
                   schema:
@@ -440,6 +540,10 @@ def get_workflow_trace(workflow_id,kind):
                      items:
                         type: array
                         items: string
+               'application/octet-stream':
+                  schema:
+                     type: string
+                     format: binary
          400:
             description: A bad trace kind was specified
             content:
@@ -459,10 +563,28 @@ def get_workflow_trace(workflow_id,kind):
       return jsonify(error(f'Unrecognized trace {kind}')), 400
    if client.exists(key)==0:
       return jsonify(error(f'Workflow {workflow_id} does not exist')), 404
-   response = []
-   for tstamp, value in trace_vector(client,key+':'+kind):
-      response.append([tstamp.isoformat(),value.flatten().tolist()])
-   return jsonify(response)
+   try:
+      cursor = int(request.args.get('cursor',0))
+      since = request.args.get('since')
+      since = datetime.fromisoformat(since) if since is not None else None
+      if since is not None and since.tzinfo is None:
+         since = since.replace(tzinfo=timezone.utc)
+   except ValueError as ex:
+      return jsonify(error(f'Bad trace parameter: {ex}')), 400
+   format = request.args.get('format','rows')
+   if format not in ['rows','columns','binary']:
+      return jsonify(error(f'Unrecognized trace format {format}')), 400
+   timestamps, values, next_cursor = read_trace(client,key+':'+kind,cursor=cursor,since=since)
+   if format=='binary':
+      output = io.BytesIO()
+      np.savez(output,timestamps=np.array(timestamps,dtype=str),values=values)
+      response = Response(output.getvalue(),mimetype='application/octet-stream')
+   elif format=='columns':
+      response = jsonify({'cursor':next_cursor,'timestamps':timestamps,'values':values.tolist()})
+   else:
+      response = jsonify([[tstamp,value] for tstamp, value in zip(timestamps,values.tolist())])
+   response.headers['X-Trace-Cursor'] = str(next_cursor)
+   return response
 
 @service.route('/workflows/<workflow_id>/graph',methods=['GET'])
 def get_workflow_graph(workflow_id):
@@ -790,7 +912,7 @@ def start_workflow_post():
 
    event_client = get_event_client()
    try:
-      workflow_id = run_workflow(workflow,event_client,input=input)
+      workflow_id = run_workflow(workflow,event_client,input=input,cache=get_flow_cache())
       return jsonify(success(f'Workflow restored as {workflow_id}',workflow=workflow_id))
    except Exception as ex:
       logging.exception(ex)
@@ -842,7 +964,7 @@ def start_workflow_upload():
       input = json.loads(input)
    event_client = get_event_client()
    try:
-      workflow_id = run_workflow(workflow,event_client,input=input)
+      workflow_id = run_workflow(workflow,event_client,input=input,cache=get_flow_cache())
       _, _, workflow_id = workflow_id.partition(':')
       return jsonify(success(f'Workflow restored as {workflow_id}',workflow=workflow_id))
    except Exception as ex:
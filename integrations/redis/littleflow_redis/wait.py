@@ -1,12 +1,15 @@
 import os
-import collections
 import threading
+import heapq
+import time
 from dataclasses import dataclass
 from uuid import uuid4
 import logging
 import json
+import hashlib
 
 from rqse import EventListener, message, receipt_for
+from rqse.client import encode_dictionary
 import redis
 from littleflow import merge
 
@@ -50,21 +53,59 @@ class TaskInfo:
    name : str
    input : 'typing.Any' = None
 
+def match_value(value):
+   # values that are equal (e.g., 1, 1.0, and True) have the same digest
+   if isinstance(value,bool):
+      return int(value)
+   if isinstance(value,float) and value.is_integer():
+      return int(value)
+   if isinstance(value,dict):
+      return {key:match_value(item) for key, item in value.items()}
+   if isinstance(value,(list,tuple)):
+      return [match_value(item) for item in value]
+   return value
+
+def match_digest(keys,values):
+   return hashlib.sha1(json.dumps([keys,match_value(list(values))],sort_keys=True,default=str).encode('UTF-8')).hexdigest()
+
+def matches(match,event):
+   for key, value in match.items():
+      if event.get(key)!=value:
+         return False
+   return True
+
+# Decrements the number of waits for a signature and removes the signature
+# from the kind when there are none left
+RELEASE_SIGNATURE_SCRIPT = """
+local count = redis.call('HINCRBY',KEYS[1],ARGV[1],-tonumber(ARGV[2]))
+if count <= 0 then
+   redis.call('HDEL',KEYS[1],ARGV[1])
+   redis.call('SREM',KEYS[2],ARGV[1])
+end
+return count
+"""
+
 class WaitForEventListener(EventListener):
-   def __init__(self,key,parent,info,event_name,send_receipt=True,match={},host='0.0.0.0',port=6379,username=None,password=None,pool=None):
-      super().__init__(key,f'wait-for-{uuid4()}',select=[event_name],host=host,port=port,username=username,password=password,pool=pool)
+   """
+   A single listener for all wait:event tasks. Pending waits are indexed in
+   Redis by event kind, the set of attributes they match on, and a digest of
+   the values they match, so an incoming event is matched with one lookup
+   per distinct attribute set instead of a scan per waiting task. The index
+   is shared by all workers in the wait-for consumer group and survives
+   restarts. Each claimed wait is checked for equality with the event as
+   an attribute missing from the event matches None.
+   """
+
+   def __init__(self,key,parent,group='wait-for',host='0.0.0.0',port=6379,username=None,password=None,pool=None):
+      super().__init__(key,group,host=host,port=port,username=username,password=password,pool=pool)
       self.parent = parent
-      self._event_name = event_name
-      self._info = info
-      self._send_receipt = send_receipt
-      self._match = match
+      self._prefix = f'{key}:waits'
       self._thread = None
+      self._release_signature = None
 
    @property
-   def target(self):
-      f = lambda : self.listen()
-      f.__name__ = f'wait_for {self._event_name} {self._match }'
-      return f
+   def prefix(self):
+      return self._prefix
 
    @property
    def thread(self):
@@ -74,83 +115,284 @@ class WaitForEventListener(EventListener):
    def thread(self,value):
       self._thread = value
 
-   def matches(self,event):
-      for key,value in self._match.items():
-         if event.get(key)!=value:
-            return False
+   def kind_key(self,kind):
+      return f'{self._prefix}:{kind}'
+
+   def counts_key(self,kind):
+      return f'{self._prefix}:{kind}:counts'
+
+   def waits_key(self,kind,keys,values):
+      return f'{self._prefix}:{kind}:{match_digest(keys,values)}'
+
+   def register(self,info,event_name,send_receipt=True,match={}):
+      """
+      Adds a pending wait for an event of the given kind whose attributes
+      match the values in match.
+      """
+      keys = sorted(match.keys())
+      signature = json.dumps(keys)
+      wait = {'workflow':info.workflow_id,'index':info.index,'name':info.name,'input':info.input,'receipt':send_receipt,'match':match}
+      pipeline = self.connection.pipeline(transaction=True)
+      pipeline.sadd(self.kind_key(event_name),signature)
+      pipeline.hincrby(self.counts_key(event_name),signature,1)
+      pipeline.hset(self.waits_key(event_name,keys,[match[key] for key in keys]),str(uuid4()),json.dumps(wait))
+      pipeline.execute()
       return True
 
+   def signatures_for(self,kind):
+      return {value.decode('UTF-8') for value in self.connection.smembers(self.kind_key(kind))}
+
+   def claim(self,kind,signature,key,event):
+      """
+      Removes and returns the waits at key that match the event. The
+      signature is removed from the kind once it has no waits.
+      """
+      client = self.connection
+      found = client.hgetall(key)
+      waits = {id:json.loads(value) for id, value in found.items()}
+      waits = {id:wait for id, wait in waits.items() if matches(wait.get('match',{}),event)}
+      claimed = []
+      if len(waits)>0:
+         pipeline = client.pipeline(transaction=False)
+         for id in waits.keys():
+            pipeline.hdel(key,id)
+         claimed = [wait for wait, removed in zip(waits.values(),pipeline.execute()) if removed]
+      if len(claimed)>0 or len(found)==0:
+         if self._release_signature is None:
+            self._release_signature = client.register_script(RELEASE_SIGNATURE_SCRIPT)
+         self._release_signature(keys=[self.counts_key(kind),self.kind_key(kind)],args=[signature,len(claimed)],client=client)
+      return claimed
+
    def process(self,event_id, event):
 
-      # check to make sure the event type matches
-      if not self.matches(event):
-         return False
+      kind = event.get('kind')
+      if kind is None:
+         return True
+      signatures = self.signatures_for(kind)
+      if len(signatures)==0:
+         return True
 
-      # send a receipt for the event
-      if self._send_receipt:
-         self.append(receipt_for(event_id))
+      # one lookup for each set of matched attributes
+      claimed = []
+      for signature in signatures:
+         keys = json.loads(signature)
+         values = [event.get(key) for key in keys]
+         claimed += self.claim(kind,signature,self.waits_key(kind,keys,values),event)
 
-      # cache the output of the wait
-      output = event.get('output')
-      if output is None:
-         output = self._info.input
-      else:
-         output = merge([self._match,output])
-      if output is not None:
-         cache = RedisOutputCache(self.connection,self._info.workflow_id)
-         retry_output_cache(cache,self._info.index,output)
-      # Generate the end task
-      event = {'name':self._info.name,'index':self._info.index,'workflow':self._info.workflow_id}
-      self.append(message(event,kind='end-task'))
+      if len(claimed)==0:
+         return True
 
-      # end the wait
-      self.stop()
-      if not self.parent.stop_work(self):
-         print('Cannot remove wait_for thread.')
+      client = self.connection
+      pipeline = client.pipeline(transaction=False)
+      for wait in claimed:
+
+         # send a receipt for the event
+         if wait.get('receipt',True):
+            pipeline.xadd(self._stream_key,encode_dictionary(receipt_for(event_id)))
+
+         # cache the output of the wait
+         output = event.get('output')
+         if output is None:
+            output = wait.get('input')
+         else:
+            output = merge([wait.get('match',{}),output])
+         if output is not None:
+            cache = RedisOutputCache(client,wait['workflow'])
+            cache.pipeline = pipeline
+            cache[wait['index']] = output
+
+         # Generate the end task
+         end = {'name':wait['name'],'index':wait['index'],'workflow':wait['workflow']}
+         pipeline.xadd(self._stream_key,encode_dictionary(message(end,kind='end-task')))
+      pipeline.execute()
       return True
 
-class Delay:
-   def __init__(self,parent,info,delay):
+class DelayScheduler:
+   """
+   Schedules wait:delay tasks on a single thread. Pending delays are kept in
+   a Redis sorted set scored by the time they are due so they survive worker
+   restarts and any worker sharing the set can fire them. A local heap of due
+   times decides when to wake, and the set is also polled so delays
+   scheduled by other workers are not stranded. Due delays are claimed by
+   removing them from the set and their end-task events are sent in a single
+   pipeline.
+   """
+
+   def __init__(self,parent,key,poll=None,batch_size=100):
       self.parent = parent
-      self._info = info
-      self._delay = delay
-      self._wait = threading.Event()
+      self._key = key
+      self._poll = poll if poll is not None else float(os.environ.get('LITTLEFLOW_DELAY_POLL',5))
+      self._batch_size = batch_size
+      self._due = []
+      self._condition = threading.Condition()
+      self._stopping = False
+      self._thread = None
 
    @property
-   def target(self):
-      f = lambda : self.run()
-      f.__name__ = f'delay {self._delay}'
-      return f
+   def key(self):
+      return self._key
 
    @property
-   def thread(self):
-      return self._thread
+   def running(self):
+      return self._thread is not None
+
+   def __len__(self):
+      return self.parent.connection.zcard(self._key)
+
+   def schedule(self,info,duration):
+      due = time.time() + duration
+      member = json.dumps({'workflow':info.workflow_id,'index':info.index,'name':info.name,'input':info.input})
+      self.parent.connection.zadd(self._key,{member:due})
+      with self._condition:
+         heapq.heappush(self._due,due)
+         self._condition.notify()
+      return True
 
-   @thread.setter
-   def thread(self,value):
-      self._thread = value
+   def start(self):
+      with self._condition:
+         if self._thread is not None:
+            return
+         self._stopping = False
+         self._thread = threading.Thread(target=self.run,daemon=True)
+         self._thread.start()
 
    def stop(self):
-      self._wait.set()
+      with self._condition:
+         thread = self._thread
+         self._stopping = True
+         self._condition.notify()
+      if thread is not None:
+         thread.join()
+      self._thread = None
+
+   def fire(self,now=None):
+      """
+      Sends the end-task events for every delay that is due and returns the
+      number fired.
+      """
+      now = now if now is not None else time.time()
+      client = self.parent.connection
+      fired = 0
+      while True:
+         members = client.zrangebyscore(self._key,'-inf',now,start=0,num=self._batch_size)
+         if len(members)==0:
+            return fired
+         claim = client.pipeline(transaction=False)
+         for member in members:
+            claim.zrem(self._key,member)
+         claimed = [member for member, removed in zip(members,claim.execute()) if removed]
+         pipeline = client.pipeline(transaction=False)
+         for member in claimed:
+            try:
+               info = json.loads(member)
+            except ValueError as ex:
+               logging.error(f'Cannot parse delay {member}: {ex}')
+               continue
+            if info.get('input') is not None:
+               cache = RedisOutputCache(client,info['workflow'])
+               cache.pipeline = pipeline
+               cache[info['index']] = info['input']
+            event = {'name':info['name'],'index':info['index'],'workflow':info['workflow']}
+            pipeline.xadd(self.parent._stream_key,encode_dictionary(message(event,kind='end-task')))
+            fired += 1
+         pipeline.execute()
+         if len(members)<self._batch_size:
+            return fired
 
    def run(self):
-      self._wait.wait(self._delay)
-      if self._info.input is not None:
-         cache = RedisOutputCache(self.parent.connection,self._info.workflow_id)
-         retry_output_cache(cache,self._info.index,self._info.input)
-      event = {'name':self._info.name,'index':self._info.index,'workflow':self._info.workflow_id}
-      self.parent.append(message(event,kind='end-task'))
-      self.stop()
-      if not self.parent.stop_work(self):
-         logging.error('Cannot remove delay thread.')
-      return True
+      while True:
+         with self._condition:
+            if self._stopping:
+               return
+            now = time.time()
+            timeout = self._poll
+            if len(self._due)>0:
+               timeout = min(timeout,max(self._due[0]-now,0))
+            if timeout>0:
+               self._condition.wait(timeout)
+            if self._stopping:
+               return
+            now = time.time()
+            while len(self._due)>0 and self._due[0]<=now:
+               heapq.heappop(self._due)
+         try:
+            self.fire(now)
+         except redis.exceptions.ConnectionError as ex:
+            logging.error(f'Connection error while firing delays: {ex}')
+
+# Increments the latch, guaranteeing the count is positive
+ACQUIRE_SCRIPT = """
+local value = redis.call('INCR',KEYS[1])
+if value < 1 then
+   redis.call('SET',KEYS[1],1)
+end
+return value
+"""
+
+# Decrements the latch and returns the new count
+RELEASE_SCRIPT = """
+return redis.call('DECR',KEYS[1])
+"""
+
+# Registers a consumer if the latch is positive, returning 0 when the latch
+# is already zero or less
+COUNTDOWN_SCRIPT = """
+local value = tonumber(redis.call('GET',KEYS[1]))
+if value == nil or value <= 0 then
+   return 0
+end
+redis.call('RPUSH',KEYS[2],ARGV[1])
+return 1
+"""
+
+# Removes and returns the consumers of a latch that has reached zero. A
+# consumers key in the older counter format is left for the caller.
+DRAIN_SCRIPT = """
+if redis.call('TYPE',KEYS[2]).ok ~= 'list' and redis.call('EXISTS',KEYS[2]) == 1 then
+   return false
+end
+local consumers = redis.call('LRANGE',KEYS[2],0,-1)
+redis.call('DEL',KEYS[2])
+local value = tonumber(redis.call('GET',KEYS[1]))
+if value == nil or value <= 0 then
+   redis.call('DEL',KEYS[1])
+end
+return consumers
+"""
+
+class LatchScripts:
+   """
+   The server-side scripts for countdown latches so that each latch
+   operation is a single atomic round trip.
+   """
+
+   def __init__(self,client):
+      self.acquire = client.register_script(ACQUIRE_SCRIPT)
+      self.release = client.register_script(RELEASE_SCRIPT)
+      self.countdown = client.register_script(COUNTDOWN_SCRIPT)
+      self.drain = client.register_script(DRAIN_SCRIPT)
 
 class WaitTaskListener(EventListener):
 
    def __init__(self,key,group='wait',host='0.0.0.0',port=6379,username=None,password=None,pool=None):
       super().__init__(key,group,select=['start-task','countdown-latch-zero'],host=host,port=port,username=username,password=password,pool=pool)
-      self._work = collections.deque()
-      self._lock = threading.RLock()
+      self._scheduler = DelayScheduler(self,f'{key}:delays')
+      self._events = WaitForEventListener(key,self,pool=self.pool)
+      self._scripts = None
+
+   @property
+   def scheduler(self):
+      return self._scheduler
+
+   @property
+   def events(self):
+      return self._events
+
+   @property
+   def scripts(self):
+      if self._scripts is None:
+         self._scripts = LatchScripts(self.connection)
+      return self._scripts
 
    def fail(self,workflow_id,index,name,reason=None):
       event = {'name':name,'index':index,'workflow':workflow_id,'status':'FAILURE'}
@@ -159,39 +401,20 @@ class WaitTaskListener(EventListener):
       self.append(message(event,kind='end-task'))
       return True
 
-   def start_work(self,work):
-      try:
-         if not self._lock.acquire(timeout=30):
-            return False
-         work.thread = threading.Thread(target=work.target)
-         self._work.append(work)
-         work.thread.start()
-         return True
-      finally:
-         self._lock.release()
-
-   def stop_work(self,work):
-      try:
-         if not self._lock.acquire(timeout=30):
-            return False
-         self._work.remove(work)
-         return True
-      finally:
-         self._lock.release()
-
    def wait_for(self,info,event_name,send_receipt=True,match={}):
       logging.info(f'Workflow {info.workflow_id} is waiting for event {event_name}')
-      listener = WaitForEventListener(self._stream_key,self,info,event_name,send_receipt,match,pool=self.pool)
-      if not self.start_work(listener):
-         return False
-      return True
+      self.start_events()
+      return self._events.register(info,event_name,send_receipt,match)
+
+   def start_events(self):
+      if self._events.thread is None:
+         self._events.thread = threading.Thread(target=lambda : self._events.listen(),daemon=True)
+         self._events.thread.start()
 
    def delay(self,info,duration):
       logging.info(f'Workflow {info.workflow_id} delay for {duration}')
-      do_delay = Delay(self,info,duration)
-      if not self.start_work(do_delay):
-         return False
-      return True
+      self._scheduler.start()
+      return self._scheduler.schedule(info,duration)
    
    def latch_keys(self,info,name):
       latch_name = f'workflow:latch:{name}'
@@ -201,17 +424,15 @@ class WaitTaskListener(EventListener):
    def acquire(self,info,name):
       latch_name, _ = self.latch_keys(info,name)
       logging.info(f'Workflow {info.workflow_id} is acquiring {latch_name}')
-      # We need to guarantee the count is positive
-      value = self.connection.incr(latch_name)
-      while value < 1:
+      value = self.scripts.acquire(keys=[latch_name],client=self.connection)
+      if value < 1:
          logging.warning(f'Workflow {info.workflow_id} acquiring returned negative count {value} on {latch_name}')
-         value = self.connection.incr(latch_name)
       return True
 
    def release(self,info,name):
       latch_name, latch_consumers = self.latch_keys(info,name)
       logging.info(f'Workflow {info.workflow_id} is releasing {latch_name}')
-      value = self.connection.decr(latch_name)
+      value = self.scripts.release(keys=[latch_name],client=self.connection)
       if value < 0:
          logging.warning(f'Workflow {info.workflow_id} release returned negative count {value} on {latch_name}')
       if value <= 0:
@@ -222,8 +443,9 @@ class WaitTaskListener(EventListener):
    def countdown(self,info,name):
       latch_name, latch_consumers = self.latch_keys(info,name)
       event = {'name':info.name,'index':info.index,'workflow':info.workflow_id}
-      value = self.connection.get(latch_name)
-      if value is None or int(value)<=0:
+      if self.connection.type(latch_consumers)==b'string':
+         self.convert_consumers(latch_name,latch_consumers)
+      if not self.scripts.countdown(keys=[latch_name,latch_consumers],args=[json.dumps(event)],client=self.connection):
          cache = RedisOutputCache(self.connection,info.workflow_id)
          retry_output_cache(cache,info.index,info.input)
          logging.warning(f' {latch_name} is already zero or less for workflow {info.workflow_id}, ending immediately')
@@ -231,15 +453,55 @@ class WaitTaskListener(EventListener):
          return True
 
       logging.info(f'Workflow {info.workflow_id} is waiting for countdown on {latch_name}')
-      count = self.connection.incr(latch_consumers)
-      consumer_info_key = f'{latch_name}:{count}'
-      consumer_info = json.dumps(event)
-      self.connection.set(consumer_info_key,consumer_info)
       return True
 
+   def convert_consumers(self,latch_name,latch_consumers):
+      # moves consumers registered as a counter with a key per consumer onto
+      # the list; only the worker that removes the counter moves them
+      pipeline = self.connection.pipeline(transaction=True)
+      pipeline.get(latch_consumers)
+      pipeline.delete(latch_consumers)
+      count, _ = pipeline.execute()
+      if count is None:
+         return
+      for consumer in range(1,int(count)+1):
+         consumer_info_key = f'{latch_name}:{consumer}'
+         pipeline = self.connection.pipeline(transaction=True)
+         pipeline.get(consumer_info_key)
+         pipeline.delete(consumer_info_key)
+         raw_json, _ = pipeline.execute()
+         if raw_json is None:
+            logging.error(f'The consumer {consumer} does not have information at {consumer_info_key}')
+         else:
+            self.connection.rpush(latch_consumers,raw_json)
+
+   def legacy_consumers(self,latch_name,latch_consumers):
+      # consumers registered as a counter with a key per consumer
+      consumers = []
+      count = self.connection.decr(latch_consumers)
+      while count >= 0 :
+         consumer_info_key = f'{latch_name}:{count+1}'
+         raw_json = self.connection.get(consumer_info_key)
+         if raw_json is None:
+            logging.error(f'The consumer {count+1} does not have information at {consumer_info_key}')
+         else:
+            consumers.append(raw_json)
+            self.connection.delete(consumer_info_key)
+         count = self.connection.decr(latch_consumers)
+      self.connection.delete(latch_name)
+      self.connection.delete(latch_consumers)
+      return consumers
+
+   def onStart(self):
+      self._scheduler.start()
+      self.start_events()
+
    def onStop(self):
-      for work in self._work:
-         work.stop()
+      self._scheduler.stop()
+      if self._events.thread is not None:
+         self._events.stop()
+         self._events.thread.join()
+         self._events.thread = None
 
    def process(self,event_id, event):
 
@@ -254,36 +516,40 @@ class WaitTaskListener(EventListener):
          if latch_consumers is None:
             latch_consumers = latch_name + ':consumers'
 
-         consumers = self.connection.decr(latch_consumers)
-         while consumers >= 0 :
-            # Get the consumer information
-            consumer_info_key = f'{latch_name}:{consumers+1}'
-            raw_json = self.connection.get(consumer_info_key)
-
-            # make sure we have something to process
-            if raw_json is None:
-               logging.error(f'The consumer {consumers+1} does not have information at {consumer_info_key}')
+         consumers = self.scripts.drain(keys=[latch_name,latch_consumers],client=self.connection)
+         if consumers is None:
+            consumers = self.legacy_consumers(latch_name,latch_consumers)
+         if len(consumers)==0:
+            return True
+
+         # The output of each step is its input so we get this from the caches
+         caches = []
+         for raw_json in consumers:
+            try:
+               event = json.loads(raw_json)
+               caches.append((event,RedisOutputCache(self.connection,event.get('workflow'))))
+            except ValueError as ex:
+               logging.error(f'Cannot parse consumer info on {latch_consumers}: {ex}')
+         fetch = self.connection.pipeline(transaction=False)
+         for event, cache in caches:
+            fetch.hget(cache.key,event.get('index')-1)
+         inputs = fetch.execute()
+
+         # send the end events
+         pipeline = self.connection.pipeline(transaction=False)
+         for (event, cache), step_input in zip(caches,inputs):
+            index = event.get('index')
+            if step_input is None:
+               step_input = cache.get(index-1)
             else:
-               # send the end event
-               try:
-                  event = json.loads(raw_json.decode('UTF-8'))
-                  cache = RedisOutputCache(self.connection,event.get('workflow'))
-                  index = event.get('index')
-                  # The output is the input of the step so we get this from the cache
-                  step_input = retry_output_cache_get(cache,index-1)
-                  retry_output_cache(cache,index,step_input)
-                  self.append(message(event,kind='end-task'))
-               except ValueError as ex:
-                  logging.error(f'Cannot parse consumer info at {consumer_info_key}: {ex}')
-
-            # get the next consumer
-            consumers = self.connection.decr(latch_consumers)
-
-         # clean as the latch is now done
-         self.connection.delete(latch_name)
-         self.connection.delete(latch_consumers)
+               step_input = json.loads(step_input)
+            if step_input is not None:
+               cache.pipeline = pipeline
+               cache[index] = step_input
+            pipeline.xadd(self._stream_key,encode_dictionary(message(event,kind='end-task')))
+         pipeline.execute()
          return True
-      
+
       # otherwise, we have a start-event for wait tasks 
       
       workflow_id = event.get('workflow')
@@ -0,0 +1,32 @@
+import importlib
+from datetime import datetime
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from littleflow_redis import read_trace
+
+service_module = importlib.import_module('littleflow_redis.service.service')
+
+def make_trace(client,key):
+   client.set(key,'{}')
+   for tstamp, vector in [('2020-01-01T00:00:00+00:00','1 0'),('2021-01-01T00:00:00+00:00','0 1')]:
+      client.lpush(key+':A',tstamp+' '+vector)
+
+def test_read_trace_naive_since():
+   client = fakeredis.FakeRedis()
+   make_trace(client,'workflow:test')
+   timestamps, values, cursor = read_trace(client,'workflow:test:A',since=datetime.fromisoformat('2020-06-01T00:00:00'))
+   assert timestamps==['2021-01-01T00:00:00+00:00']
+   assert values.tolist()==[[0,1]]
+   assert cursor==2
+
+def test_service_naive_since(monkeypatch):
+   client = fakeredis.FakeRedis()
+   make_trace(client,'workflow:test')
+   monkeypatch.setattr(service_module,'get_redis',lambda : client)
+   response = service_module.service.test_client().get('/workflows/test/trace/A?since=2000-01-01T00:00:00')
+   assert response.status_code==200
+   assert len(response.json)==2
+   assert response.headers['X-Trace-Cursor']=='2'
@@ -1,10 +1,11 @@
 __version__=(0,13,0)
 __author__='Alex Miłowski'
 __author_email__='alex@milowski.com'
-from .parser import Parser
+from .parser import Parser, IncrementalParser
 from .model import Workflow, Declaration, SubFlow, Statement, Start, End, Iterate, Task, LiteralSource, ResourceSource, ResourceSink, ParameterLiteral
-from .compiler import Compiler
-from .runner import Context, Runner, TaskContext, FunctionTaskContext, pass_input, pass_parameters, merge, task
-from .flow import Invocation, Source, Sink, InvokeTask, InvokeFlow, Flow
+from .compiler import Compiler, IncrementalCompiler
+from .runner import Context, Runner, TaskContext, FunctionTaskContext, ExecutorTaskContext, pass_input, pass_parameters, merge, task, BatchContext, BatchRunner, AsyncContext, AsyncRunner, AsyncTaskContext
+from .flow import Invocation, Source, Sink, InvokeTask, InvokeFlow, Flow, Transitions
 from .doc import graph_name, graph
-from .utils import run_workflow, TaskFailure, WorkflowFailure
+from .cache import FlowCache, FlowStore, DirectoryFlowStore, source_key
+from .utils import run_workflow, run_workflow_async, TaskFailure, WorkflowFailure
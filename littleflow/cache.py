@@ -0,0 +1,148 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+from .parser import Parser
+from .compiler import Compiler
+from .flow import Flow
+
+def source_key(source):
+   """
+   Returns the content address (a SHA-256 hex digest) of workflow source text.
+   """
+   if type(source)==str:
+      source = source.encode('UTF-8')
+   return hashlib.sha256(source).hexdigest()
+
+class FlowStore:
+   """
+   A secondary tier for a FlowCache that stores serialized flows by key.
+   """
+
+   def get(self,key):
+      return None
+
+   def set(self,key,flow):
+      pass
+
+class DirectoryFlowStore(FlowStore):
+   """
+   Stores flows in their binary serialization as files in a directory.
+   """
+
+   def __init__(self,path):
+      self._path = path
+      os.makedirs(path,exist_ok=True)
+
+   def get(self,key):
+      try:
+         with open(os.path.join(self._path,key+'.flw'),'rb') as raw:
+            return Flow.from_bytes(raw.read())
+      except FileNotFoundError:
+         return None
+
+   def set(self,key,flow):
+      target = os.path.join(self._path,key+'.flw')
+      partial = f'{target}.{os.getpid()}.{threading.get_ident()}'
+      with open(partial,'wb') as output:
+         output.write(flow.to_bytes())
+      os.replace(partial,target)
+
+class FlowCache:
+   """
+   A content-addressed cache of compiled flows keyed by the hash of the
+   workflow source. Flows are kept in a least-recently-used memory cache
+   in front of an optional FlowStore. The parser and compiler are only
+   used when neither tier has the flow. Each lookup returns a copy of the
+   cached flow so that changes to the invocation parameters by one run are
+   not seen by another.
+   """
+
+   def __init__(self,size=128,store=None):
+      self._size = size
+      self._store = store
+      self._flows = OrderedDict()
+      self._lock = threading.Lock()
+      self._hits = 0
+      self._store_hits = 0
+      self._misses = 0
+
+   @property
+   def hits(self):
+      """
+      The number of lookups satisfied by the memory tier
+      """
+      return self._hits
+
+   @property
+   def store_hits(self):
+      """
+      The number of lookups satisfied by the store tier
+      """
+      return self._store_hits
+
+   @property
+   def misses(self):
+      """
+      The number of lookups that required compilation
+      """
+      return self._misses
+
+   @property
+   def store(self):
+      return self._store
+
+   def __len__(self):
+      return len(self._flows)
+
+   def clear(self):
+      with self._lock:
+         self._flows.clear()
+
+   def _remember(self,key,flow):
+      with self._lock:
+         self._flows[key] = flow
+         self._flows.move_to_end(key)
+         while len(self._flows)>self._size:
+            self._flows.popitem(last=False)
+
+   def get(self,key):
+      with self._lock:
+         flow = self._flows.get(key)
+         if flow is not None:
+            self._flows.move_to_end(key)
+            self._hits += 1
+            return flow.copy()
+      if self._store is not None:
+         flow = self._store.get(key)
+         if flow is not None:
+            self._store_hits += 1
+            self._remember(key,flow)
+            return flow.copy()
+      return None
+
+   def compile(self,source):
+      """
+      Returns the compiled flow for the workflow source, parsing and compiling
+      only on a cache miss.
+      """
+      if type(source)==bytes:
+         source = source.decode('UTF-8')
+      elif type(source)!=str:
+         source = source.read()
+      key = source_key(source)
+      flow = self.get(key)
+      if flow is not None:
+         return flow
+      with self._lock:
+         self._misses += 1
+      flow = Compiler().compile(Parser().parse(source))
+      self._remember(key,flow)
+      if self._store is not None:
+         try:
+            self._store.set(key,flow)
+         except Exception as ex:
+            logging.warning(f'Unable to store compiled flow {key}: {ex}')
+      return flow.copy()
@@ -1,9 +1,11 @@
 import json
+import copy
 
 import yaml
 from jsonpath2.path import Path
 
 from .model import Workflow, SubFlow, Task, LiteralSource, Start, End, LiteralType
+from .parser import IncrementalParser
 from .flow import Flow, Source, Sink, InvokeTask, InvokeFlow, StartFlow, Guard
 
 def compile_literal(text,type=LiteralType.EMPTY):
@@ -44,6 +46,12 @@ class Compiler:
    def __init__(self):
       pass
 
+   def literal(self,text,type=LiteralType.EMPTY):
+      return compile_literal(text,type)
+
+   def guard(self,step,expression):
+      return Guard(step,expression)
+
    def compile(self,model):
 
       size = len(model.indexed)
@@ -57,12 +65,12 @@ class Compiler:
             if decl is not None:
                if decl.parameters is not None:
                   try:
-                     value = compile_literal(decl.parameters.value,decl.parameters.type)
+                     value = self.literal(decl.parameters.value,decl.parameters.type)
                   except ValueError as ex:
                      raise ValueError(f'{decl.parameters.line}:{decl.parameters.column} {ex}')
             if step.parameters is not None:
                try:
-                  invocation_value = compile_literal(step.parameters.value,step.parameters.type)
+                  invocation_value = self.literal(step.parameters.value,step.parameters.type)
                   if len(value)==0:
                      value = invocation_value
                   elif type(value)!=type(invocation_value):
@@ -78,7 +86,7 @@ class Compiler:
                except ValueError as ex:
                   raise ValueError(f'{step.parameters.line}:{step.parameters.column} {ex}')
             if step.guard is not None:
-               guard = Guard(step,step.guard)
+               guard = self.guard(step,step.guard)
             else:
                guard = None
             flow[index] = InvokeTask(index,step.name,value,merge=step.merge,guard=guard)
@@ -87,13 +95,13 @@ class Compiler:
                flow[index].base = decl.base
          elif isinstance(step,LiteralSource):
             try:
-               value = compile_literal(step.value,step.type)
+               value = self.literal(step.value,step.type)
                flow[index] = Source(index,value)
             except ValueError as ex:
                raise ValueError(f'{step.line}:{step.column} {ex}')
          elif isinstance(step,SubFlow):
             if step.guard is not None:
-               guard = Guard(step,step.guard)
+               guard = self.guard(step,step.guard)
             else:
                guard = None
             flow[index] = InvokeFlow(index,end=step.named_inputs['end'].index,merge=step.merge,guard=guard)
@@ -141,4 +149,72 @@ class Compiler:
             target = subflow.named_inputs.get(name)
             if target is not None:
                flow.F[source.index,target.index] = 1
+      flow.reindex()
+      return flow
+
+class IncrementalCompiler(Compiler):
+   """
+   A compiler for successive versions of the same workflow (e.g., while it
+   is edited). The source is parsed with an IncrementalParser and the
+   compiled parameter literals and guards are reused from the previous
+   compilation when their text has not changed. The transitions are always
+   rebuilt from the model.
+   """
+
+   def __init__(self,parser=None):
+      super().__init__()
+      self._parser = parser if parser is not None else IncrementalParser()
+      self._compiled = {}
+      self._previous = {}
+      self._source = None
+      self._flow = None
+
+   @property
+   def parser(self):
+      return self._parser
+
+   def clear(self):
+      self._parser.clear()
+      self._compiled = {}
+      self._source = None
+      self._flow = None
+
+   def _reuse(self,key,compile):
+      value = self._compiled.get(key)
+      if value is None:
+         value = self._previous.pop(key,None)
+         if value is None:
+            value = compile()
+         self._compiled[key] = value
+      return value
+
+   def literal(self,text,type=LiteralType.EMPTY):
+      # literal values are copied as the flow may be modified
+      return copy.deepcopy(self._reuse(('literal',text,type),lambda : compile_literal(text,type)))
+
+   def guard(self,step,expression):
+      return self._reuse(('guard',expression),lambda : Guard(step,expression))
+
+   def compile(self,model):
+      self._previous, self._compiled = self._compiled, {}
+      try:
+         return super().compile(model)
+      except Exception:
+         self._compiled.update(self._previous)
+         raise
+      finally:
+         self._previous = {}
+
+   def update(self,source):
+      """
+      Parses and compiles a new version of the workflow source, reusing the
+      unchanged statements from the previous version.
+      """
+      if type(source)!=str:
+         source = source.read()
+      if self._flow is not None and source==self._source:
+         return self._flow
+      flow = self.compile(self._parser.parse(source))
+      self._source = source
+      self._flow = flow
       return flow
@@ -34,12 +34,10 @@ def graph(flow,output,format='mermaid',name='workflow',embed_docs=True,left_to_r
       elif isinstance(invocation,InvokeTask):
          print(f'  state "{invocation.name}" as {name}',file=output)
 
-   for index,row in enumerate(flow.F):
+   for index in range(size):
       source = flow[index]
       source_name = graph_name(source,end=size-1)
-      for target_index, value in enumerate(row.flatten()):
-         if value==0:
-            continue
+      for target_index in flow.F.successors(index):
          target = flow[target_index]
          #print(source,target)
          target_name = graph_name(target,end=size-1)
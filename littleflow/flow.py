@@ -1,4 +1,9 @@
 import json
+import re
+import copy
+import struct
+import zlib
+import functools
 
 import numpy as np
 from dataclasses import dataclass, field
@@ -35,23 +40,227 @@ class InvokeFlow(Invocation):
    merge: bool = False
    guard: Path = None
 
+# jsonpath2 does not unescape quoted strings and so those with a backslash
+# are left to jsonpath2
+_GUARD_KEY = r'(?:\.([A-Za-z_][A-Za-z0-9_]*)|\["([^"\\]*)"\])'
+_GUARD_LITERAL = r'(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|"[^"\\]*"|true|false|null)'
+_GUARD_PATTERN = re.compile(r'\$((?:' + _GUARD_KEY + r')*)(?:\[\?\(\s*@((?:' + _GUARD_KEY + r')+)\s*(?:(!?=)\s*' + _GUARD_LITERAL + r')?\s*\)\])?')
+_GUARD_KEYS = re.compile(_GUARD_KEY)
+
+def _guard_keys(path):
+   return [name if name else json.loads(f'"{quoted}"') for name, quoted in _GUARD_KEYS.findall(path)]
+
+def _guard_lookup(obj,keys):
+   for key in keys:
+      if type(obj)!=dict or key not in obj:
+         return False, None
+      obj = obj[key]
+   return True, obj
+
+def compile_guard(expression):
+   """
+   Compiles a guard expression to a Python predicate when it is a simple key
+   path optionally followed by a filter testing a key path for existence or
+   (in)equality with a literal. Returns None for any other expression.
+   """
+   match = _GUARD_PATTERN.fullmatch(expression.strip())
+   if match is None:
+      return None
+   path, filter_path, operator, literal = match.group(1), match.group(4), match.group(7), match.group(8)
+   keys = _guard_keys(path)
+   if filter_path is None:
+      return lambda obj : _guard_lookup(obj,keys)[0]
+
+   # a filter applies to the object at the path itself
+   filter_keys = _guard_keys(filter_path)
+   def lookup(obj):
+      found, node = _guard_lookup(obj,keys)
+      if not found or type(node)!=dict:
+         return False, None
+      return _guard_lookup(node,filter_keys)
+   if operator is None:
+      return lambda obj : lookup(obj)[0]
+   value = json.loads(literal)
+   if operator=='=':
+      def equals(obj):
+         found, current = lookup(obj)
+         return found and current==value
+      return equals
+   def not_equals(obj):
+      found, current = lookup(obj)
+      return found and current!=value
+   return not_equals
+
+@functools.lru_cache(maxsize=256)
+def parse_guard(expression):
+   return Path.parse_str(expression)
+
 class Guard:
    def __init__(self,source,expression):
-      try:
-         self._repr = expression
-         self._expr = Path.parse_str(expression)
-      except ValueError as ex:
-         raise ValueError(f'{source.line}:{source.column} Cannot parse guard `{expression}`: {ex}')
+      self._repr = expression
+      self._expr = None
+      self._predicate = compile_guard(expression)
+      if self._predicate is None:
+         try:
+            self._expr = parse_guard(expression)
+         except ValueError as ex:
+            if source is None:
+               raise ValueError(f'Cannot parse guard `{expression}`: {ex}')
+            raise ValueError(f'{source.line}:{source.column} Cannot parse guard `{expression}`: {ex}')
 
    def __repr__(self):
       return f'`{self._repr}`'
 
+   @property
+   def expression(self):
+      return self._repr
+
+   @property
+   def compiled(self):
+      """
+      Whether the guard is evaluated by a compiled predicate rather than jsonpath
+      """
+      return self._predicate is not None
+
    def matches(self,obj):
+      if self._expr is None:
+         self._expr = parse_guard(self._repr)
       return [m.current_value for m in self._expr.match(obj)]
    
    def should_execute(self,obj):
-      return len(self.matches(obj))>0
+      if self._predicate is not None:
+         return self._predicate(obj)
+      for _ in self._expr.match(obj):
+         return True
+      return False
+
+
+class Transitions:
+   """
+   A sparse zero/one step transition matrix stored as adjacency sets. The
+   interface mirrors the subset of a numpy matrix used by the runner so that
+   the cost of a transition scales with the number of edges rather than the
+   square of the number of steps.
+   """
+
+   def __init__(self,size,rows=None,columns=None):
+      self._size = size
+      self._rows = rows if rows is not None else [set() for _ in range(size)]
+      self._columns = columns if columns is not None else [set() for _ in range(size)]
+
+   @staticmethod
+   def from_dense(matrix):
+      matrix = np.asarray(matrix)
+      assert len(matrix.shape)==2 and matrix.shape[0]==matrix.shape[1], f'The transition matrix must be square: {matrix.shape}'
+      F = Transitions(matrix.shape[0])
+      for source, target in zip(*np.nonzero(matrix)):
+         F[int(source),int(target)] = 1
+      return F
+
+   @staticmethod
+   def from_edges(size,sources,targets):
+      F = Transitions(size)
+      for source, target in zip(sources.tolist(),targets.tolist()):
+         F[source,target] = 1
+      return F
+
+   def edge_arrays(self):
+      """
+      Returns the source and target indices of every edge as two arrays.
+      """
+      edges = list(self.edges())
+      sources = np.array([source for source, _ in edges],dtype=int)
+      targets = np.array([target for _, target in edges],dtype=int)
+      return sources, targets
+
+   @property
+   def shape(self):
+      return (self._size,self._size)
+
+   @property
+   def T(self):
+      """
+      The transpose of the matrix. The adjacency sets are shared with this matrix.
+      """
+      return Transitions(self._size,rows=self._columns,columns=self._rows)
+
+   def successors(self,index):
+      """
+      The sorted column indices of the non-zero entries of a row.
+      """
+      return sorted(self._rows[index])
+
+   def predecessors(self,index):
+      """
+      The sorted row indices of the non-zero entries of a column.
+      """
+      return sorted(self._columns[index])
+
+   def edges(self):
+      for source in range(self._size):
+         for target in self.successors(source):
+            yield source, target
+
+   def __getitem__(self,key):
+      if isinstance(key,tuple):
+         row, column = key
+         return 1 if column in self._rows[row] else 0
+      row = np.zeros(self._size,dtype=int)
+      row[self.successors(key)] = 1
+      return row
 
+   def __setitem__(self,key,value):
+      row, column = key
+      if value:
+         self._rows[row].add(column)
+         self._columns[column].add(row)
+      else:
+         self._rows[row].discard(column)
+         self._columns[column].discard(row)
+
+   def __iter__(self):
+      for index in range(self._size):
+         yield self[index]
+
+   def __len__(self):
+      return self._size
+
+   def __array__(self,dtype=None,copy=None):
+      return self.toarray() if dtype is None else self.toarray().astype(dtype)
+
+   def __str__(self):
+      return str(self.toarray())
+
+   def dot(self,E):
+      """
+      Multiplies the matrix by a vector or matrix E of shape (n,) or (n,k).
+      Only the rows of E with non-zero entries are visited.
+      """
+      E = np.asarray(E)
+      result = np.zeros(E.shape,dtype=np.result_type(E.dtype,int))
+      for column in np.flatnonzero(E.reshape((E.shape[0],-1)).any(axis=1)):
+         for row in self._columns[column]:
+            result[row] += E[column]
+      return result
+
+   def __matmul__(self,E):
+      return self.dot(E)
+
+   def sum(self,axis=None):
+      if axis==0:
+         return np.array([len(column) for column in self._columns],dtype=int)
+      elif axis==1:
+         return np.array([len(row) for row in self._rows],dtype=int)
+      return sum(len(row) for row in self._rows)
+
+   def toarray(self):
+      matrix = np.zeros(self.shape,dtype=int)
+      for source, target in self.edges():
+         matrix[source,target] = 1
+      return matrix
+
+   def tolist(self):
+      return self.toarray().tolist()
 
 class Flow:
 
@@ -63,15 +272,25 @@ class Flow:
       'StartFlow' : StartFlow
    }
 
+   FORMAT_MAGIC = b'LFLW'
+   FORMAT_VERSION = 1
+   __header = struct.Struct('<4sBII')
+
    def __init__(self,size=0,serialized=None,name=None):
       self._name = name
       if serialized is None:
          assert size>0
-         self._F = np.zeros((size,size),dtype=int)
+         self._F = Transitions(size)
          self._tasks = [None]*size
       else:
-         self._F = np.array(serialized['F'])
-         self._tasks = [Flow.__classes[T[0]](**T[1]) for T in serialized['T']]
+         self._F = Transitions.from_dense(serialized['F'])
+         self._tasks = [Flow.__classes[T[0]](**Flow.__decode_invocation(T[1])) for T in serialized['T']]
+         if name is None:
+            self._name = serialized.get('name')
+      self._predecessors = None
+      self._successors = None
+      if serialized is not None:
+         self.reindex()
 
    @property
    def name(self):
@@ -85,6 +304,31 @@ class Flow:
    def F(self):
       return self._F
 
+   def reindex(self):
+      """
+      Computes the predecessor and successor index arrays of every step from
+      the transition matrix. This must be called again if F is modified.
+      """
+      size = self._F.shape[0]
+      self._predecessors = [np.array(self._F.predecessors(index),dtype=int) for index in range(size)]
+      self._successors = [np.array(self._F.successors(index),dtype=int) for index in range(size)]
+
+   def predecessors(self,index):
+      """
+      The indices of the steps that transition into the step at index.
+      """
+      if self._predecessors is None:
+         self.reindex()
+      return self._predecessors[index]
+
+   def successors(self,index):
+      """
+      The indices of the steps that the step at index transitions to.
+      """
+      if self._successors is None:
+         self.reindex()
+      return self._successors[index]
+
    def __getitem__(self,index):
       return self._tasks[index]
 
@@ -97,9 +341,95 @@ class Flow:
    def __str__(self):
       return json.dumps(self.save())
 
+   @staticmethod
+   def __encode_invocation(invocation):
+      value = dict(invocation.__dict__)
+      if isinstance(value.get('guard'),Guard):
+         value['guard'] = value['guard'].expression
+      return value
+
+   @staticmethod
+   def __decode_invocation(value):
+      if isinstance(value.get('guard'),str):
+         value = dict(value)
+         value['guard'] = Guard(None,value['guard'])
+      return value
+
+   def copy(self):
+      """
+      Returns a copy of the flow that shares the transitions but has its own
+      copies of the invocations, their parameters, and the source values.
+      """
+      flow = Flow.__new__(Flow)
+      flow._name = self._name
+      flow._F = self._F
+      flow._tasks = [Flow.__copy_invocation(T) for T in self._tasks]
+      flow._predecessors = self._predecessors
+      flow._successors = self._successors
+      return flow
+
+   @staticmethod
+   def __copy_invocation(invocation):
+      if invocation is None:
+         return None
+      invocation = copy.copy(invocation)
+      if isinstance(invocation,InvokeTask):
+         invocation.parameters = copy.deepcopy(invocation.parameters)
+      elif isinstance(invocation,Source):
+         invocation.value = copy.deepcopy(invocation.value)
+      return invocation
+
    def save(self):
       R = {
          'F' : self._F.tolist(),
-         'T' : [[T.__class__.__name__,T.__dict__] for T in self._tasks]
+         'T' : [[T.__class__.__name__,Flow.__encode_invocation(T)] for T in self._tasks]
       }
+      if self._name is not None:
+         R['name'] = self._name
       return R
+
+   def to_bytes(self):
+      """
+      Returns the compact binary serialization of the flow: a versioned
+      header, the edge list of F as little-endian 32-bit indices, and the
+      compressed JSON encoding of the invocations.
+      """
+      sources, targets = self._F.edge_arrays()
+      invocations = {
+         'T' : [[T.__class__.__name__,Flow.__encode_invocation(T)] for T in self._tasks]
+      }
+      if self._name is not None:
+         invocations['name'] = self._name
+      return Flow.__header.pack(Flow.FORMAT_MAGIC,Flow.FORMAT_VERSION,len(self._tasks),len(sources)) + \
+             sources.astype('<u4').tobytes() + \
+             targets.astype('<u4').tobytes() + \
+             zlib.compress(json.dumps(invocations,separators=(',',':')).encode('UTF-8'))
+
+   @staticmethod
+   def is_bytes(data):
+      """
+      Indicates whether the data is in the binary serialization format.
+      """
+      return data[:len(Flow.FORMAT_MAGIC)]==Flow.FORMAT_MAGIC
+
+   @staticmethod
+   def from_bytes(data):
+      """
+      Restores a flow from the binary serialization produced by to_bytes().
+      """
+      if not Flow.is_bytes(data):
+         raise ValueError('The data is not a serialized flow.')
+      _, version, size, count = Flow.__header.unpack_from(data)
+      if version!=Flow.FORMAT_VERSION:
+         raise ValueError(f'Unsupported flow serialization version {version}')
+      offset = Flow.__header.size
+      sources = np.frombuffer(data,dtype='<u4',count=count,offset=offset)
+      offset += 4*count
+      targets = np.frombuffer(data,dtype='<u4',count=count,offset=offset)
+      offset += 4*count
+      invocations = json.loads(zlib.decompress(data[offset:]).decode('UTF-8'))
+      flow = Flow(size,name=invocations.get('name'))
+      flow._F = Transitions.from_edges(size,sources,targets)
+      flow._tasks = [Flow.__classes[T[0]](**Flow.__decode_invocation(T[1])) for T in invocations['T']]
+      flow.reindex()
+      return flow
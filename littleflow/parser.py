@@ -1,5 +1,8 @@
 import logging
+import os
+import threading
 from lark import Lark, Token, Tree
+from lark.exceptions import UnexpectedInput, UnexpectedEOF, UnexpectedToken
 
 from .model import Workflow, Declaration, SubFlow, MeetShorthand, Statement, Start, End, Iterate, Task, LiteralSource, ResourceSource, ResourceSink, ParameterLiteral, LiteralType
 
@@ -75,15 +78,42 @@ def find_position(tree,target):
             target.line = child.line
             target.column = child.column
             return;
+_lark_parsers = {}
+_lark_lock = threading.Lock()
+
+def lark_parser(cache=None):
+   """
+   Returns the LALR parser for the grammar. The parser tables are built once
+   and shared by every Parser. The cache argument is passed to Lark: True
+   uses a temporary file and a string is the path of the cache file. When
+   not specified, the LITTLEFLOW_PARSER_CACHE environment variable is used.
+   """
+   if cache is None:
+      cache = os.environ.get('LITTLEFLOW_PARSER_CACHE')
+   cache = cache if cache is not None else False
+   parser = _lark_parsers.get(cache)
+   if parser is None:
+      with _lark_lock:
+         parser = _lark_parsers.get(cache)
+         if parser is None:
+            parser = Lark(grammar,parser='lalr',start='flow',propagate_positions=True,cache=cache)
+            _lark_parsers[cache] = parser
+   return parser
+
 class Parser:
 
-   def __init__(self):
-      self._parser = Lark(grammar,parser='lalr',start='flow',propagate_positions=True)
+   def __init__(self,cache=None):
+      self._parser = lark_parser(cache=cache)
 
    def parse(self,source):
       if type(source)!=str:
          source = source.read()
-      ast = self._parser.parse(source)
+      return self.build(self._parser.parse(source))
+
+   def build(self,ast):
+      """
+      Builds the workflow model from a parse tree.
+      """
 
       from_start = []
 
@@ -347,3 +377,188 @@ class Parser:
          assert index==item.index, f'Index for item at {index} does not match: {item}'
 
       return workflow
+
+class _Reparse(Exception):
+   pass
+
+def _shift(fragment,index_delta,line_delta):
+   # Moves the steps of a parsed fragment to new indices and lines
+   flows = fragment.flows[1:] + [decl.subflow for decl in fragment.declarations.values() if decl.subflow is not None]
+   statements = fragment.flows[0].statements + [statement for flow in flows for statement in flow.statements]
+   steps = {}
+   for step in fragment.indexed[1:-1] + [step for flow in flows for step in list(flow.named_inputs.values()) + list(flow.named_outputs.values())]:
+      steps[id(step)] = step
+      if isinstance(step,Iterate):
+         steps[id(step.step)] = step.step
+   literals = {}
+   for decl in fragment.declarations.values():
+      if decl.parameters is not None:
+         literals[id(decl.parameters)] = decl.parameters
+   for step in steps.values():
+      step.index += index_delta
+      if isinstance(step,(Task,LiteralSource)):
+         step.line += line_delta
+      parameters = getattr(step,'parameters',None)
+      if parameters is not None:
+         literals[id(parameters)] = parameters
+   for statement in statements:
+      statement.line += line_delta
+   for literal in literals.values():
+      literal.line += line_delta
+
+def split_statements(source):
+   """
+   Splits workflow source into chunks of whole lines that each end with a
+   top-level statement terminator. Each chunk is a tuple of the starting
+   line and the text.
+   """
+   chunks = []
+   current = []
+   start = 1
+   depth = 0
+   for number, line in enumerate(source.splitlines(keepends=True),1):
+      current.append(line)
+      text = line.strip()
+      if text.startswith('#'):
+         continue
+      depth = max(depth + text.count('{') - text.count('}'),0)
+      if depth==0 and text.endswith(';'):
+         chunks.append((start,''.join(current)))
+         current = []
+         start = number + 1
+   if len(current)>0:
+      # trailing blank lines and comments stay with the last statement
+      significant = any(len(line.strip())>0 and not line.strip().startswith('#') for line in current)
+      if significant or len(chunks)==0:
+         chunks.append((start,''.join(current)))
+      else:
+         chunks[-1] = (chunks[-1][0],chunks[-1][1]+''.join(current))
+   return chunks
+
+class IncrementalParser(Parser):
+   """
+   A parser for successive versions of the same workflow (e.g., while it is
+   edited). The source is split into top-level statements that are parsed
+   independently. Statements whose text has not changed since the previous
+   parse reuse their model, moved to their new indices and lines, and only
+   changed statements are parsed. When statements cannot be combined
+   independently (e.g., a label defined twice), the whole source is parsed.
+
+   The models returned by previous parses share steps with later models and
+   should not be used after the next parse.
+   """
+
+   def __init__(self,cache=None):
+      super().__init__(cache=cache)
+      self._fragments = {}
+      self._parsed = 0
+      self._reused = 0
+
+   @property
+   def parsed(self):
+      """
+      The number of statement chunks that have been parsed
+      """
+      return self._parsed
+
+   @property
+   def reused(self):
+      """
+      The number of statement chunks reused from a previous parse
+      """
+      return self._reused
+
+   def clear(self):
+      self._fragments = {}
+
+   def parse(self,source):
+      if type(source)!=str:
+         source = source.read()
+      try:
+         return self.parse_incremental(source)
+      except _Reparse:
+         self._fragments = {}
+         return super().parse(source)
+
+   def parse_chunk(self,text):
+      try:
+         return self.build(self._parser.parse(text))
+      except (ValueError, AssertionError):
+         raise _Reparse()
+
+   def parse_incremental(self,source):
+      chunks = split_statements(source)
+      if len(chunks)==0:
+         raise _Reparse()
+      previous = self._fragments
+      fragments = {}
+
+      workflow = Workflow()
+      root = SubFlow(0)
+      start = Start(0)
+      end = End(-1)
+      root.named_outputs['start'] = start
+      root.named_inputs['start'] = start
+      root.named_inputs['end'] = end
+      workflow.flows.append(root)
+      workflow.indexed.append(start)
+
+      position = 0
+      while position<len(chunks):
+         line, text = chunks[position]
+         position += 1
+         reusable = previous.get(text)
+         if reusable is not None and len(reusable)>0:
+            fragment, index_offset, line_offset = reusable.pop()
+            self._reused += 1
+         else:
+            extend = 1
+            while True:
+               try:
+                  fragment = self.parse_chunk(text)
+                  break
+               except UnexpectedInput as ex:
+                  at_end = isinstance(ex,UnexpectedEOF) or (isinstance(ex,UnexpectedToken) and ex.token.type=='$END')
+                  if at_end and position<len(chunks):
+                     # the statement continues into the following chunks
+                     text += ''.join(chunk for _, chunk in chunks[position:position+extend])
+                     position += extend
+                     extend *= 2
+                     continue
+                  # keep the unchanged statements for the next parse
+                  for key, items in fragments.items():
+                     previous.setdefault(key,[]).extend(items)
+                  self._fragments = previous
+                  if isinstance(ex.line,int):
+                     ex.line += line - 1
+                  raise ex
+            index_offset, line_offset = 0, 0
+            self._parsed += 1
+
+         index = len(workflow.indexed) - 1
+         _shift(fragment,index - index_offset,(line - 1) - line_offset)
+         fragments.setdefault(text,[]).append((fragment,index,line - 1))
+
+         fragment_root = fragment.flows[0]
+         root.statements += fragment_root.statements
+         for labels, merged in [(fragment_root.named_inputs,root.named_inputs),(fragment_root.named_outputs,root.named_outputs)]:
+            for label, step in labels.items():
+               if step is fragment.indexed[0] or step is fragment.indexed[-1]:
+                  continue
+               if label in merged and merged[label] is not start and merged[label] is not end:
+                  raise _Reparse()
+               merged[label] = step
+         workflow.flows += fragment.flows[1:]
+         workflow.indexed += fragment.indexed[1:-1]
+         workflow.declarations.update(fragment.declarations)
+         if fragment.name is not None:
+            workflow.name = fragment.name
+
+      end.index = len(workflow.indexed)
+      workflow.indexed.append(end)
+      for index,item in enumerate(workflow.indexed):
+         if index!=item.index:
+            raise _Reparse()
+
+      self._fragments = fragments
+      return workflow
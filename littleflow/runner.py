@@ -1,5 +1,9 @@
 from queue import SimpleQueue
+import threading
 import types
+import asyncio
+import inspect
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
 from .flow import Flow, Source, Sink, InvokeTask, InvokeFlow, StartFlow
@@ -11,6 +15,20 @@ class TaskContext:
       immediate[invocation.index] = 1
       context.ending.put(immediate)
 
+   @property
+   def pending(self):
+      """
+      The number of invoked tasks that have not yet ended. A loop draining the
+      ending queue should check this before checking that the queue is empty.
+      """
+      return 0
+
+   def check(self):
+      """
+      Raises the failure of any task that ended with an exception.
+      """
+      pass
+
 def pass_parameters(func):
    if hasattr(func,'__invocation__'):
       getattr(func,'__invocation__').append('raw_parameters')
@@ -41,7 +59,10 @@ class FunctionTaskContext(TaskContext):
    def __init__(self,lookup):
       self._lookup = lookup
 
-   def invoke(self,context,invocation,input):
+   def resolve(self,invocation,input):
+      """
+      Returns the function, positional arguments, and keywords for a task invocation.
+      """
       f = self._lookup.get(invocation.name)
       if f is None:
          raise ValueError(f'Cannot find task {invocation.name} in function lookup.')
@@ -68,9 +89,12 @@ class FunctionTaskContext(TaskContext):
                args += invocation.parameters
          else:
             args.append(invocation.parameters)
+      return f, args, keywords
 
-      output = f(*args,**keywords)
-
+   def complete(self,context,invocation,output):
+      """
+      Records the output of a task and ends it.
+      """
       if output is None:
          output = {}
       elif type(output)==tuple:
@@ -83,6 +107,88 @@ class FunctionTaskContext(TaskContext):
       immediate[invocation.index] = 1
       context.ending.put(immediate)
 
+   def invoke(self,context,invocation,input):
+      f, args, keywords = self.resolve(invocation,input)
+      self.complete(context,invocation,f(*args,**keywords))
+
+class ExecutorTaskContext(FunctionTaskContext):
+   """
+   A function task context that runs tasks on an executor so that the tasks
+   started together (e.g., the branches of a fork) run concurrently. The
+   executor is 'thread', 'process', or a concurrent.futures.Executor. When
+   a process pool is used, task functions and their inputs must be
+   picklable. Each task ends by putting its ending vector on the context's
+   ending queue as it finishes.
+   """
+
+   def __init__(self,lookup,executor='thread',max_workers=None):
+      super().__init__(lookup)
+      if executor=='thread':
+         self._executor = ThreadPoolExecutor(max_workers=max_workers)
+         self._owned = True
+      elif executor=='process':
+         self._executor = ProcessPoolExecutor(max_workers=max_workers)
+         self._owned = True
+      elif isinstance(executor,Executor):
+         self._executor = executor
+         self._owned = False
+      else:
+         raise ValueError(f'Unrecognized executor {executor}')
+      self._pending = 0
+      self._failures = []
+      self._lock = threading.Lock()
+
+   @property
+   def executor(self):
+      return self._executor
+
+   @property
+   def pending(self):
+      with self._lock:
+         return self._pending
+
+   def invoke(self,context,invocation,input):
+      f, args, keywords = self.resolve(invocation,input)
+      with self._lock:
+         self._pending += 1
+      try:
+         future = self._executor.submit(f,*args,**keywords)
+      except Exception:
+         with self._lock:
+            self._pending -= 1
+         raise
+      future.add_done_callback(lambda future : self._completed(context,invocation,future))
+
+   def _completed(self,context,invocation,future):
+      # The ending is put and the task is no longer pending in one step so
+      # that a loop checking pending before the queue never misses it.
+      with self._lock:
+         try:
+            self.complete(context,invocation,future.result())
+         except Exception as ex:
+            self._failures.append((invocation,ex))
+            # wake up anything waiting on the queue
+            context.ending.put(context.new_transition())
+         finally:
+            self._pending -= 1
+
+   def check(self):
+      with self._lock:
+         if len(self._failures)==0:
+            return
+         invocation, ex = self._failures.pop(0)
+      raise ex
+
+   def shutdown(self,wait=True):
+      if self._owned:
+         self._executor.shutdown(wait=wait)
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self,exc_type,exc_value,traceback):
+      self.shutdown()
+
 def merge(input):
    if type(input)!=list:
       return input
@@ -94,6 +200,51 @@ def merge(input):
          result[key] = value
    return result
 
+class EndingQueue:
+   """
+   The queue of vectors for the steps that have ended. In addition to
+   getting vectors one at a time, the queue can be drained into a single
+   vector so the flow advances once for many ended steps.
+   """
+
+   def __init__(self):
+      self._queue = SimpleQueue()
+      self._held = None
+
+   def put(self,E):
+      self._queue.put(E)
+
+   def get(self):
+      if self._held is not None:
+         E, self._held = self._held, None
+         return E
+      return self._queue.get()
+
+   def empty(self):
+      return self._held is None and self._queue.empty()
+
+   def qsize(self):
+      return self._queue.qsize() + (1 if self._held is not None else 0)
+
+   def drain(self,E=None):
+      """
+      Returns the sum of the queued vectors, waiting for one if the queue is
+      empty. A vector ending a step already in the sum is held for the next
+      get so that a step ends at most once in each transition.
+      """
+      if E is None:
+         E = self.get()
+      E = np.asarray(E)
+      ended = E>0
+      while self._held is None and not self._queue.empty():
+         V = np.asarray(self._queue.get()).reshape(E.shape)
+         if (ended & (V>0)).any():
+            self._held = V
+            break
+         E = E + V
+         ended = E>0
+      return E
+
 class Context:
    def __init__(self,flow,state=None,activation=None,cache={},task_context=TaskContext()):
       self._flow = flow
@@ -102,7 +253,7 @@ class Context:
       self._T[np.where(self._T == 0)] = 1
       self._T = self._T.reshape((self.F.shape[0],1))
       self._S = state if state is not None else np.zeros((self.F.shape[0],1),dtype=int)
-      self._ends = SimpleQueue()
+      self._ends = EndingQueue()
       self._cache = cache
       self._task_context = task_context
 
@@ -161,55 +312,75 @@ class Context:
    def new_transition(self):
       return np.zeros((self.F.shape[0],1),dtype=int)
 
+   _dispatch = {
+      InvokeTask : '_start_invoke_task',
+      Source : '_start_source',
+      Sink : '_start_sink',
+      InvokeFlow : '_start_invoke_flow',
+      StartFlow : '_start_flow'
+   }
+
    def start(self,tasks):
       """
       Called when steps are started. The tasks argument is a boolean vector
       whose position correspond to the indexed steps that should be started.
       The default implementation immediately ends tasks.
       """
-      immediate = np.zeros(tasks.shape,dtype=int)
-      for index,task in enumerate(tasks.flatten()):
-         if task:
-            invocation = self.flow[index]
-            input = self.input_for(index)
-            assert input is not None, f'None value return for {index}'
-            if isinstance(invocation,InvokeTask):
-               if invocation.merge:
-                  input = merge(input)
-               if invocation.guard is not None:
-                  if not invocation.guard.should_execute(input):
-                     self.output_for(index,input)
-                     immediate[index] = 1
-                     continue
-
-               self.start_task(invocation,input)
-            elif isinstance(invocation,Source):
-               self.output_for(index,invocation.value)
-               immediate[index] = 1
-            elif isinstance(invocation,Sink):
-               if invocation.merge:
-                  input = merge(input)
-               self.output_for(index,input)
-               immediate[index] = 1
-            elif isinstance(invocation,InvokeFlow):
-               if invocation.merge:
-                  input = merge(input)
-               if invocation.guard is not None:
-                  if not invocation.guard.should_execute(input):
-                     self.output_for(invocation.end,input)
-                     immediate[invocation.end] = 1
-                     continue
-
-               self.output_for(index,input)
-               immediate[index] = 1
-            elif isinstance(invocation,StartFlow):
-               self.output_for(index,input)
-               immediate[index] = 1
-            else:
-               immediate[index] = 1
-
-      if immediate.sum()>0:
-         self.ending.put(immediate)
+      immediate = []
+      for index in np.flatnonzero(tasks).tolist():
+         ended = self.start_step(index)
+         if ended is not None:
+            immediate.append(ended)
+
+      if len(immediate)>0:
+         E = self.new_transition()
+         E[immediate] = 1
+         self.ending.put(E)
+
+   def start_step(self,index):
+      """
+      Starts a single step and returns the index of the step that ended
+      immediately, if any.
+      """
+      invocation = self.flow[index]
+      input = self.input_for(index)
+      assert input is not None, f'None value return for {index}'
+      handler = Context._dispatch.get(type(invocation))
+      return getattr(self,handler)(invocation,input) if handler is not None else index
+
+   def _start_invoke_task(self,invocation,input):
+      if invocation.merge:
+         input = merge(input)
+      if invocation.guard is not None:
+         if not invocation.guard.should_execute(input):
+            self.output_for(invocation.index,input)
+            return invocation.index
+      self.start_task(invocation,input)
+      return None
+
+   def _start_source(self,invocation,input):
+      self.output_for(invocation.index,invocation.value)
+      return invocation.index
+
+   def _start_sink(self,invocation,input):
+      if invocation.merge:
+         input = merge(input)
+      self.output_for(invocation.index,input)
+      return invocation.index
+
+   def _start_invoke_flow(self,invocation,input):
+      if invocation.merge:
+         input = merge(input)
+      if invocation.guard is not None:
+         if not invocation.guard.should_execute(input):
+            self.output_for(invocation.end,input)
+            return invocation.end
+      self.output_for(invocation.index,input)
+      return invocation.index
+
+   def _start_flow(self,invocation,input):
+      self.output_for(invocation.index,input)
+      return invocation.index
 
    def end(self,tasks):
       """
@@ -234,12 +405,13 @@ class Context:
       if index == 0:
          item = self._cache.get(-1)
          return {} if item is None else item
-      value = []
-      for target, transition in enumerate(self.F.T[index].flatten()):
-         if transition > 0:
-            item = self._cache.get(target)
-            if item is not None:
-               value.append(item)
+      predecessors = self.flow.predecessors(index)
+      if hasattr(self._cache,'get_many'):
+         # caches that can retrieve several values at once (e.g., remote caches)
+         items = self._cache.get_many(predecessors)
+      else:
+         items = [self._cache.get(target) for target in predecessors]
+      value = [item for item in items if item is not None]
       if len(value)==0:
          return {}
       elif len(value)==1:
@@ -256,8 +428,22 @@ class Context:
 
 class Runner:
 
-   def __init__(self):
-      pass
+   def __init__(self,drain=False):
+      self._drain = drain
+
+   @property
+   def drain(self):
+      """
+      Whether the queued ending vectors are summed into one transition
+      """
+      return self._drain
+
+   def advance(self,context):
+      """
+      Runs the algorithm forward from the next ending vector of the context or,
+      when draining, from every queued ending vector at once.
+      """
+      return self.next(context,context.ending.drain() if self._drain else context.ending.get())
 
    def start(self,context,input=None):
       if input is not None:
@@ -290,3 +476,370 @@ class Runner:
       if (1*N).sum()>0:
          context.start(N)
       return context.S.sum()>0
+
+class EndingAccumulator:
+   """
+   A queue-like collection of ending vectors. Every vector put is summed into
+   a single pending matrix so that a get returns all the steps that have
+   ended since the previous get.
+   """
+
+   def __init__(self,shape):
+      self._shape = shape
+      self._E = None
+      self._lock = threading.Lock()
+
+   def put(self,E,column=None):
+      E = np.asarray(E)
+      with self._lock:
+         if self._E is None:
+            self._E = np.zeros(self._shape,dtype=int)
+         if column is None:
+            self._E += E
+         else:
+            rows = np.flatnonzero(E)
+            self._E[rows,column] += E.flat[rows]
+
+   def get(self):
+      with self._lock:
+         E = self._E if self._E is not None else np.zeros(self._shape,dtype=int)
+         self._E = None
+         return E
+
+   def empty(self):
+      return self._E is None
+
+class InstanceEnding:
+   """
+   The ending queue of a single instance of a batch which writes into the
+   instance's column of the batch ending matrix.
+   """
+
+   def __init__(self,batch,instance):
+      self._batch = batch
+      self._instance = instance
+
+   def put(self,E):
+      self._batch.ending.put(E,column=self._instance)
+
+   def empty(self):
+      return self._batch.ending.empty()
+
+class InstanceContext(Context):
+   """
+   A view of a single workflow instance within a BatchContext. The state
+   vectors are the instance's column of the batch matrices and the instance
+   has its own output cache.
+   """
+
+   def __init__(self,batch,instance,cache):
+      self._flow = batch.flow
+      self._batch = batch
+      self._instance = instance
+      self._cache = cache
+      self._ends = InstanceEnding(batch,instance)
+
+   @property
+   def instance(self):
+      return self._instance
+
+   @property
+   def S(self):
+      return self._batch.S[:,self._instance:self._instance+1]
+
+   @property
+   def A(self):
+      return self._batch.A[:,self._instance:self._instance+1]
+
+   @property
+   def T(self):
+      return self._batch.T[:,self._instance:self._instance+1]
+
+   @property
+   def task_context(self):
+      return self._batch.task_context
+
+   def ended(self,value):
+      self._batch.ended(self._instance,value)
+
+   def start_task(self,invocation,input):
+      self._batch.task_context.invoke(self,invocation,input)
+
+class BatchContext:
+   """
+   The state of k instances of the same flow. The state, activation, and
+   threshold are (n,k) matrices where each column is an instance.
+   """
+
+   def __init__(self,flow,size,caches=None,task_context=TaskContext()):
+      assert size>0, 'The batch must contain at least one instance.'
+      self._flow = flow
+      steps = self.F.shape[0]
+      self._S = np.zeros((steps,size),dtype=int)
+      self._A = np.zeros((steps,size),dtype=int)
+      T = flow.F.sum(axis=0)
+      T[np.where(T == 0)] = 1
+      self._T = np.broadcast_to(T.reshape((steps,1)),(steps,size))
+      self._ends = EndingAccumulator((steps,size))
+      self._caches = caches if caches is not None else [{} for _ in range(size)]
+      assert len(self._caches)==size, f'The number of caches ({len(self._caches)}) does not match the batch size ({size})'
+      self._task_context = task_context
+      self._instances = [InstanceContext(self,instance,cache) for instance, cache in enumerate(self._caches)]
+
+   @property
+   def flow(self):
+      """
+      The workflow for the batch
+      """
+      return self._flow
+
+   @property
+   def F(self):
+      """
+      The step transition matrix.
+      """
+      return self._flow.F
+
+   @property
+   def S(self):
+      """
+      Indicates which steps are currently active for each instance.
+      """
+      return self._S
+
+   @property
+   def A(self):
+      """
+      The currently accumulated activations for each instance
+      """
+      return self._A
+
+   @property
+   def T(self):
+      """
+      The activation threshold (the same for every instance)
+      """
+      return self._T
+
+   @property
+   def size(self):
+      """
+      The number of instances in the batch
+      """
+      return len(self._instances)
+
+   @property
+   def ending(self):
+      return self._ends
+
+   @property
+   def caches(self):
+      return self._caches
+
+   @property
+   def task_context(self):
+      return self._task_context
+
+   @task_context.setter
+   def task_context(self,value):
+      self._task_context = value
+
+   def __getitem__(self,instance):
+      return self._instances[instance]
+
+   def new_transition(self):
+      return np.zeros(self._S.shape,dtype=int)
+
+   def start(self,tasks):
+      """
+      Called when steps are started. The tasks argument is a boolean matrix
+      whose columns are the steps to start for each instance.
+      """
+      steps = []
+      instances = []
+      for index, instance in np.argwhere(tasks).tolist():
+         ended = self._instances[instance].start_step(index)
+         if ended is not None:
+            steps.append(ended)
+            instances.append(instance)
+
+      if len(steps)>0:
+         E = self.new_transition()
+         E[steps,instances] = 1
+         self.ending.put(E)
+
+   def end(self,tasks):
+      """
+      Called when steps end. The tasks argument is a boolean matrix
+      whose columns are the steps that have finished for each instance.
+      """
+      pass
+
+   def ended(self,instance,value):
+      pass
+
+   def accumulate(self,value):
+      pass
+
+   def output(self,instance):
+      """
+      The output of the final step for an instance.
+      """
+      return self._instances[instance].input_for(self.F.shape[0]-1)
+
+class BatchRunner:
+
+   def __init__(self):
+      pass
+
+   def start(self,context,inputs=None):
+      if inputs is not None:
+         assert len(inputs)==context.size, f'The number of inputs ({len(inputs)}) does not match the batch size ({context.size})'
+         for instance, input in enumerate(inputs):
+            if input is not None:
+               context[instance].output_for(-1,input)
+      context.A[0] = 1
+      context.ending.put(context.new_transition())
+      context.accumulate(context.A)
+
+   def next(self,context,E):
+      """
+      Runs the algorithm forward for every instance from a matrix whose
+      columns represent the steps that have ended for each instance.
+
+      context - The batch context
+      E - a zero/one or boolean matrix indicating which steps have ended
+      """
+      E = 1*E
+      activations = context.F.T.dot(E)
+      context.accumulate(activations)
+      context._A = context._A + activations
+      if E.sum()>0:
+         context.end(E>0)
+      N = context.A >= context.T
+      context._A = context.A - 1*N * context.T
+      context._S = np.maximum(context.S - E + 1*N,0)
+      if N.any():
+         context.start(N)
+      return context.S.sum()>0
+
+   def run(self,context,inputs=None):
+      """
+      Starts every instance and runs the batch until no steps are ending.
+      """
+      self.start(context,inputs=inputs)
+      while not context.ending.empty():
+         self.next(context,context.ending.get())
+      return [context.output(instance) for instance in range(context.size)]
+
+class AsyncEnding:
+   """
+   The ending queue for an asyncio context. Vectors are put without waiting
+   and the runner awaits the next vector.
+   """
+
+   def __init__(self):
+      self._queue = asyncio.Queue()
+      self._held = None
+
+   def put(self,E):
+      self._queue.put_nowait(E)
+
+   async def get(self):
+      if self._held is not None:
+         E, self._held = self._held, None
+         return E
+      return await self._queue.get()
+
+   def empty(self):
+      return self._held is None and self._queue.empty()
+
+   async def drain(self):
+      """
+      Returns the sum of the queued vectors as with EndingQueue.drain
+      """
+      E = np.asarray(await self.get())
+      ended = E>0
+      while self._held is None and not self._queue.empty():
+         V = np.asarray(self._queue.get_nowait()).reshape(E.shape)
+         if (ended & (V>0)).any():
+            self._held = V
+            break
+         E = E + V
+         ended = E>0
+      return E
+
+class AsyncTaskContext(FunctionTaskContext):
+   """
+   A function task context for an asyncio context. Tasks defined with
+   async def are scheduled on the running event loop so the tasks started
+   together (e.g., the branches of a fork) overlap while they await. Plain
+   functions are called inline as with FunctionTaskContext.
+   """
+
+   def __init__(self,lookup):
+      super().__init__(lookup)
+      self._tasks = set()
+      self._failures = []
+
+   @property
+   def pending(self):
+      return len(self._tasks)
+
+   def invoke(self,context,invocation,input):
+      f, args, keywords = self.resolve(invocation,input)
+      if not inspect.iscoroutinefunction(f):
+         self.complete(context,invocation,f(*args,**keywords))
+         return
+      task = asyncio.get_running_loop().create_task(f(*args,**keywords))
+      self._tasks.add(task)
+      task.add_done_callback(lambda task : self._completed(context,invocation,task))
+
+   def _completed(self,context,invocation,task):
+      self._tasks.discard(task)
+      try:
+         self.complete(context,invocation,task.result())
+      except BaseException as ex:
+         self._failures.append((invocation,ex))
+         # wake up the runner waiting on the queue
+         context.ending.put(context.new_transition())
+
+   def check(self):
+      if len(self._failures)==0:
+         return
+      invocation, ex = self._failures.pop(0)
+      raise ex
+
+   def cancel(self):
+      for task in list(self._tasks):
+         task.cancel()
+
+class AsyncContext(Context):
+   """
+   A context whose ending queue can be awaited by an AsyncRunner.
+   """
+
+   def __init__(self,flow,state=None,activation=None,cache=None,task_context=None):
+      super().__init__(flow,state=state,activation=activation,cache=cache if cache is not None else {},task_context=task_context if task_context is not None else TaskContext())
+      self._ends = AsyncEnding()
+
+class AsyncRunner(Runner):
+   """
+   Runs a workflow on an event loop, awaiting the tasks that have not ended.
+   """
+
+   async def run(self,context,input=None):
+      """
+      Starts the workflow and runs it until no steps are ending or pending.
+      """
+      self.start(context,input=input)
+      task_context = context.task_context
+      try:
+         while task_context.pending>0 or not context.ending.empty():
+            self.next(context,await (context.ending.drain() if self.drain else context.ending.get()))
+            task_context.check()
+      except BaseException:
+         if isinstance(task_context,AsyncTaskContext):
+            task_context.cancel()
+         raise
+      return context.input_for(len(context.flow)-1)
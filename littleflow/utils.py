@@ -1,4 +1,4 @@
-from littleflow import Parser, Compiler, Runner, Context, FunctionTaskContext
+from littleflow import Parser, Compiler, Runner, Context, FunctionTaskContext, ExecutorTaskContext, AsyncRunner, AsyncContext, AsyncTaskContext
 
 class WorkflowFailure(Exception):
    pass
@@ -11,27 +11,57 @@ class TaskFailure(WorkflowFailure):
          super().__init__(f'Task {task} failed: {message}',*args,**kwargs)
 
 
-def run_workflow(workflow,lookup=None,context=None,input=None):
+def compile_workflow(workflow,cache=None):
+   if cache is not None:
+      return cache.compile(workflow)
    p = Parser()
    c = Compiler()
    model = p.parse(workflow)
-   flow = c.compile(model)
+   return c.compile(model)
 
-   runner = Runner()
+def run_workflow(workflow,lookup=None,context=None,input=None,cache=None,executor=None,max_workers=None,drain=False):
+   flow = compile_workflow(workflow,cache=cache)
+
+   runner = Runner(drain=drain)
+   task_context = None
+   if lookup is not None:
+      task_context = ExecutorTaskContext(lookup,executor=executor,max_workers=max_workers) if executor is not None else FunctionTaskContext(lookup)
    if context is None:
-      context = Context(flow,task_context=FunctionTaskContext(lookup))
-   elif lookup is not None:
-      context.task_context = FunctionTaskContext(lookup)
+      context = Context(flow,task_context=task_context if task_context is not None else FunctionTaskContext(lookup))
+   elif task_context is not None:
+      context.task_context = task_context
 
    try:
       runner.start(context,input=input)
 
-      while not context.ending.empty():
-         runner.next(context,context.ending.get())
+      while context.task_context.pending>0 or not context.ending.empty():
+         runner.advance(context)
+         context.task_context.check()
    except TaskFailure as ex:
       raise WorkflowFailure('The workflow failed due to a task failure.') from ex
    except Exception as ex:
       raise WorkflowFailure('The workflow failed due to an exception.') from ex
+   finally:
+      if isinstance(task_context,ExecutorTaskContext):
+         task_context.shutdown()
 
 
    return context.input_for(len(flow)-1), context
+
+async def run_workflow_async(workflow,lookup=None,context=None,input=None,cache=None,drain=False):
+   flow = compile_workflow(workflow,cache=cache)
+
+   runner = AsyncRunner(drain=drain)
+   if context is None:
+      context = AsyncContext(flow,task_context=AsyncTaskContext(lookup))
+   elif lookup is not None:
+      context.task_context = AsyncTaskContext(lookup)
+
+   try:
+      output = await runner.run(context,input=input)
+   except TaskFailure as ex:
+      raise WorkflowFailure('The workflow failed due to a task failure.') from ex
+   except Exception as ex:
+      raise WorkflowFailure('The workflow failed due to an exception.') from ex
+
+   return output, context
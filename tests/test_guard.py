@@ -0,0 +1,75 @@
+import random
+
+import pytest
+from jsonpath2.path import Path
+
+from littleflow.flow import compile_guard
+
+compiled_expressions = [
+   '$',
+   '$.status',
+   '$["status"]',
+   '$.a.status',
+   '$[?(@.status)]',
+   '$[?(@.status=0)]',
+   '$[?(@.status = 1)]',
+   '$[?( @.status = 1 )]',
+   ' $.a[?(@.status=0)] ',
+   '$[?(@.status="0")]',
+   '$[?(@.status!=0)]',
+   '$[?(@.status=true)]',
+   '$[?(@.status=1.0)]',
+   '$[?(@.status=1.5)]',
+   '$[?(@.status=-2)]',
+   '$[?(@.status=null)]',
+   '$[?(@.s.t=1)]',
+   '$[?(@["st x"]=null)]',
+   '$.a["b"][?(@.c!="x")]',
+]
+
+jsonpath_expressions = [
+   '$[?(@.x = "a\\"b")]',
+   '$["a\\"b"]',
+   '$[?(@.status>0)]',
+   '$[*]',
+   '$..status',
+   '$[?(@.status=0 and @.x=1)]',
+   '$.a[0]',
+]
+
+values = [0,1,1.0,'0','1','x','a"b','a\\"b',None,True,False,1.5,-2,0.0,[],{},[{'status':0}]]
+keys = ['status','a','s','t','b','c','st x','x','a"b','a\\"b']
+
+def document(rng,depth=0):
+   if depth>2 or rng.random()<0.4:
+      return rng.choice(values)
+   if rng.random()<0.2:
+      return [document(rng,depth+1) for _ in range(rng.randint(0,2))]
+   return {rng.choice(keys):document(rng,depth+1) for _ in range(rng.randint(0,3))}
+
+def documents():
+   rng = random.Random(1)
+   generated = [document(rng) for _ in range(2000)]
+   specific = [
+      {'status':0}, {'status':1}, {'status':1.0}, {'status':True}, {'status':False}, {'status':0.0}, {'status':None}, {},
+      {'status':[1]}, {'status':{'status':1}}, {'a':[{'status':0}]}, {'a':'status'}, {'a':{'status':0}}, {'a':None},
+      {'s':{'t':1}}, {'s':[1]}, {'a':{'b':{'c':'y'}}}, {'a':{'b':[]}}, {'st x':None},
+      {'x':'a"b'}, {'x':'a\\"b'}, {'a"b':1}, {'a\\"b':1},
+      [{'status':0}], [], [1],
+   ]
+   return [value for value in generated + specific if isinstance(value,(dict,list))]
+
+def jsonpath_matches(path,obj):
+   return any(True for _ in path.match(obj))
+
+@pytest.mark.parametrize('expression',compiled_expressions)
+def test_compiled_guard_matches_jsonpath(expression):
+   predicate = compile_guard(expression)
+   assert predicate is not None
+   path = Path.parse_str(expression)
+   for obj in documents():
+      assert predicate(obj)==jsonpath_matches(path,obj), obj
+
+@pytest.mark.parametrize('expression',jsonpath_expressions)
+def test_guard_left_to_jsonpath(expression):
+   assert compile_guard(expression) is None
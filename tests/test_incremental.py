@@ -0,0 +1,79 @@
+import glob
+import os
+
+import pytest
+from lark.exceptions import UnexpectedInput
+
+from littleflow import Parser, IncrementalParser, Compiler, IncrementalCompiler
+
+test_dir = os.path.dirname(__file__)
+workflows = sorted(glob.glob(os.path.join(test_dir,'**','*.flow'),recursive=True))
+
+def outcome(compile,source,model=False):
+   """
+   Returns a comparable summary of compiling (or parsing) the source or the
+   error raised.
+   """
+   try:
+      result = compile(source)
+   except UnexpectedInput as ex:
+      return ('syntax',ex.line,ex.column)
+   except (ValueError, AssertionError, AttributeError, NotImplementedError) as ex:
+      return (type(ex).__name__,str(ex))
+   if model:
+      return ('model',result)
+   return ('flow',result.name,sorted(result.F.edges()),[repr(invocation) for invocation in result])
+
+def full(source):
+   return Compiler().compile(Parser().parse(source))
+
+def edits(lines):
+   """
+   Yields versions of the source with each line deleted, duplicated, and
+   swapped with the next.
+   """
+   for index in range(len(lines)):
+      yield lines[:index] + lines[index+1:]
+      yield lines[:index+1] + lines[index:]
+      if index+1<len(lines):
+         yield lines[:index] + [lines[index+1],lines[index]] + lines[index+2:]
+
+@pytest.mark.parametrize('path',workflows,ids=lambda path : os.path.relpath(path,test_dir))
+def test_incremental_edits(path):
+   with open(path) as raw:
+      source = raw.read()
+   compiler = IncrementalCompiler()
+   assert outcome(compiler.update,source)==outcome(full,source)
+   for lines in edits(source.split('\n')):
+      edited = '\n'.join(lines)
+      assert outcome(compiler.update,edited)==outcome(full,edited), edited
+   # returning to the original reuses the statements of the edits
+   assert outcome(compiler.update,source)==outcome(full,source)
+
+@pytest.mark.parametrize('path',workflows,ids=lambda path : os.path.relpath(path,test_dir))
+def test_incremental_parse_edits(path):
+   # the models include the lines and columns of the steps and statements
+   with open(path) as raw:
+      source = raw.read()
+   parser = IncrementalParser()
+   for lines in edits(source.split('\n')):
+      edited = '\n'.join(lines)
+      assert outcome(parser.parse,edited,model=True)==outcome(Parser().parse,edited,model=True), edited
+
+def test_incremental_syntax_error_line():
+   statements = [f'A{index} → B{index} ({{"n":{index}}});' for index in range(20)]
+   compiler = IncrementalCompiler()
+   compiler.update('\n'.join(statements))
+   broken = statements[:12] + ['C → → D;'] + statements[12:]
+   expected = outcome(full,'\n'.join(broken))
+   assert expected[0]=='syntax' and expected[1]==13
+   assert outcome(compiler.update,'\n'.join(broken))==expected
+   # the statements before the error are still reused afterwards
+   parsed = compiler.parser.parsed
+   assert outcome(compiler.update,'\n'.join(statements[:12] + ['C → D;'] + statements[12:]))==outcome(full,'\n'.join(statements[:12] + ['C → D;'] + statements[12:]))
+   assert compiler.parser.parsed==parsed+1
+
+def test_incremental_unchanged_source():
+   compiler = IncrementalCompiler()
+   flow = compiler.update('A → B;\nC')
+   assert compiler.update('A → B;\nC') is flow